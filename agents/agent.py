@@ -5,14 +5,17 @@ from transport.transportation import Transportation, Route, RoutedTransportation
 from transport.checkpoint import Checkpoint, generate_checkpoints
 from graphing.graph import Graph, RegionGraph
 from graphing.core import Node, Edge
-from graphing.mapping import shortest_edge_path
 from graphing.mapping import shortest_path
 from agents.core import Household, Firm
 from agents.core import Establishment
+from agents.table import AgentTable, COMPARTMENTS, COMPARTMENT_CODES, STATES, STATE_CODES
+from objects import Disease
+import numpy as np
 import logging
 import random
 import math
 import manager
+import counters
 
 LOGGER = logging.getLogger("Agent")
 AGE_RANGE_DISTRIBUTION = {
@@ -30,6 +33,29 @@ def compute_for_chance_of_infection(chance_per_contact:float, contact_rate:float
     chance_of_not_infected = math.exp(-force_of_infection)
     return 1 - chance_of_not_infected
 
+def check_for_infections(agents:list['Agent'], chance_per_contact:float, contact_rate:float, infected_density:float, duration:int, time:int, disease:Disease, state:str|None=None) -> int:
+    """Batched check_for_infection for agents sharing one site. The force of infection is computed once,
+    all Bernoulli outcomes are drawn together and incubation periods are sampled only for the newly exposed."""
+    if (not agents):
+        return 0
+
+    chance_infection = compute_for_chance_of_infection(chance_per_contact, contact_rate, infected_density, duration)
+    if (chance_infection <= 0):
+        return 0
+
+    rows = np.fromiter((agent.row for agent in agents), dtype=np.int64, count=len(agents))
+    candidates = Agent.table.compartment[rows] == COMPARTMENT_CODES['S']
+    if (state):
+        candidates &= Agent.table.state[rows] == STATE_CODES[state]
+    exposed = np.flatnonzero(candidates & (np.random.random(len(agents)) <= chance_infection))
+    if (not len(exposed)):
+        return 0
+
+    incubation_periods = disease.sample_many('incubation_period', len(exposed))
+    for index, incubation_period in zip(exposed.tolist(), incubation_periods.tolist()):
+        agents[index].expose(time + incubation_period)
+    return len(exposed)
+
 @lru_cache(maxsize=128, typed=False)
 def compute_mortality_rate(age:int) -> float:
     exponent = (-10.2 + (0.106 * age))
@@ -53,38 +79,118 @@ def next_occurrence_of_hour(current_time, target_hour):
 
 
 class Agent:
-    id:int = 0
-    destination:Establishment = None
+    """Scalar fields that population-wide passes read live in Agent.table; the rest stay on the instance."""
+    __slots__ = (
+        'id', 'row', 'household', 'city', 'railway', 'destination', 'current_establishment',
+        'commuting', 'private', 'arrival_time', 'boarding_time', 'checkpoints', 'current_node',
+        '_transportation', 'consumed', 'symptomatic', 'full_counter', 'tested'
+        )
+    counter:int = 0
+    table:AgentTable = AgentTable()
+    destination:Establishment
     current_establishment:Establishment
     commuting:bool
     private:str
-    arrival_time:int = 0
-    boarding_time:int = 0
+    arrival_time:int
+    boarding_time:int
     checkpoints:list[Checkpoint]
-    current_node:Node = None
-    transportation:Transportation = None
-    consumed:bool = False
-    symptomatic:bool = False
-    masked:bool = False
-    infection_multiplier:int = 1
-    full_counter:int = 0
-    isolate:bool = False
-    tested:bool = False
-    state:str = 'home'
+    current_node:Node
 
     def __init__(self, age:int, city:RegionGraph, railway:Graph, household:Household, compartment:str='S'):
+        self.row = Agent.table.append()
+        counters.add_agent(self.SEIR_compartment, self.state)
         self.age = age
         self.SEIR_compartment = compartment
+        self.state = 'home'
         self.household = household
+        Agent.table.household[self.row] = household.id
+        self.destination = None
+        self.arrival_time = 0
+        self.boarding_time = 0
+        self.checkpoints = []
+        self.current_node = None
+        self.transportation = None
+        self.consumed = False
+        self.symptomatic = False
+        self.full_counter = 0
+        self.tested = False
         self.current_establishment = household
         self.current_establishment.add_agent(self)
         self.commuting = random.random() < 0.8
+        self.private = None
         if (not self.commuting):
             self.private = 'car' if (random.random() < 0.7) else 'bike'
         self.city = city
         self.railway = railway
-        self.id = Agent.id
-        Agent.id += 1
+        self.id = Agent.counter
+        Agent.counter += 1
+
+    @property
+    def SEIR_compartment(self) -> str:
+        return COMPARTMENTS[Agent.table.compartment[self.row]]
+
+    @SEIR_compartment.setter
+    def SEIR_compartment(self, compartment:str):
+        counters.change_compartment(self.SEIR_compartment, compartment)
+        Agent.table.compartment[self.row] = COMPARTMENT_CODES[compartment]
+
+    @property
+    def state(self) -> str:
+        return STATES[Agent.table.state[self.row]]
+
+    @state.setter
+    def state(self, state:str):
+        old_state = self.state
+        counters.change_state(old_state, state)
+        Agent.table.state[self.row] = STATE_CODES[state]
+        if ((old_state == 'travelling') != (state == 'travelling')):
+            mode = self.travel_mode()
+            counters.change_travel_mode(mode if old_state == 'travelling' else None, mode if state == 'travelling' else None)
+
+    @property
+    def transportation(self) -> Transportation:
+        return self._transportation
+
+    @transportation.setter
+    def transportation(self, transportation:Transportation):
+        if (self.state == 'travelling'):
+            counters.change_travel_mode(self.travel_mode(), transportation.method if transportation else 'walking')
+        self._transportation = transportation
+
+    def travel_mode(self) -> str:
+        return self._transportation.method if self._transportation else 'walking'
+
+    @property
+    def age(self) -> int:
+        return int(Agent.table.age[self.row])
+
+    @age.setter
+    def age(self, age:int):
+        Agent.table.age[self.row] = age
+
+    @property
+    def isolate(self) -> bool:
+        return bool(Agent.table.isolate[self.row])
+
+    @isolate.setter
+    def isolate(self, isolate:bool):
+        Agent.table.isolate[self.row] = isolate
+
+    @property
+    def masked(self) -> bool:
+        return bool(Agent.table.masked[self.row])
+
+    @masked.setter
+    def masked(self, masked:bool):
+        Agent.table.masked[self.row] = masked
+
+    @property
+    def infection_multiplier(self) -> float:
+        return float(Agent.table.infection_multiplier[self.row])
+
+    @infection_multiplier.setter
+    def infection_multiplier(self, infection_multiplier:float):
+        Agent.table.infection_multiplier[self.row] = infection_multiplier
     
     def ride_transportation(self, transportation:Transportation, time:int, compliance_rate:float=1):
         if (isinstance(transportation, RoutedTransportation) and transportation.is_full() and random.random() < compliance_rate):
@@ -92,18 +198,14 @@ class Agent:
         
         self.transportation = transportation
         self.boarding_time = time
-        transportation.agents.append(self)
-        if (self.SEIR_compartment == 'I'):
-            transportation.no_infected_agents += self.infection_multiplier
+        transportation.add_agent(self)
         self.set_state('travelling')
-        self.current_node.agents.remove(self)
+        self.current_node.remove_agent(self)
         self.current_node = None
     
     def alight_transportation(self):
         if (self.transportation):
-            self.transportation.agents.remove(self)
-            if (self.SEIR_compartment == 'I'):
-                self.transportation.no_infected_agents -= self.infection_multiplier
+            self.transportation.remove_agent(self)
             self.transportation = None
     
     def set_state(self, state:Literal['home', 'travelling', 'waiting', 'working', 'consuming']):
@@ -115,13 +217,18 @@ class Agent:
         
         chance_infection = compute_for_chance_of_infection(chance_per_contact, contact_rate, infected_density, duration)
         if (random.random() <= chance_infection):
-            self.SEIR_compartment = 'E'
+            self.expose(time + incubation_period)
+
+    def expose(self, infection_time:int):
+        self.SEIR_compartment = 'E'
 
-            if (self.current_establishment):
-                self.current_establishment.sync_agent_state(self, "S")
+        if (self.current_establishment):
+            self.current_establishment.sync_agent_state(self, "S")
+        if (self.transportation):
+            self.transportation.sync_agent_state(self, "S")
 
-            infection_event = manager.Event(manager.AGENT_INFECTED, self)
-            manager.emit(time + incubation_period, infection_event)
+        infection_event = manager.Event(manager.AGENT_INFECTED, self)
+        manager.emit(infection_time, infection_event)
     
     def set_path(self, destination:Establishment, time:int, company_compliance:float, mask_compliance:float):
         self.current_establishment.remove_agent(self)
@@ -130,11 +237,11 @@ class Agent:
         self.infection_multiplier = masked_multiplier * asymptomatic_multiplier
         self.destination = destination
         self.current_node = self.current_establishment.node
-        self.current_node.agents.append(self)
+        self.current_node.add_agent(self)
         if (self.current_node.id == destination.node.id):
             self.arrived_at_destination(time, company_compliance)
         else:
-            path:list[Edge] = shortest_edge_path(self.current_node.id, self.destination.node.id, self.city, self.railway)
+            path:list[Edge] = self.city.distances.path(self.current_node.id, self.destination.node.id)
             if (not path):
                 raise ValueError(f"No path found from node {self.current_node.id} to node {self.destination.node.id}.")
 
@@ -153,7 +260,7 @@ class Agent:
         self.infection_multiplier = masked_multiplier * asymptomatic_multiplier
         self.destination = destination
         self.current_node = self.current_establishment.node
-        self.current_node.agents.append(self)
+        self.current_node.add_agent(self)
         if (self.current_node.id == destination.node.id):
             self.arrived_at_destination(time, company_compliance)
         else:
@@ -178,12 +285,12 @@ class Agent:
         if (self.commuting and self.state == 'travelling'):
             finished_checkpoint = self.checkpoints.pop(0)
             self.current_node = finished_checkpoint.end_node
-            self.current_node.agents.append(self)
+            self.current_node.add_agent(self)
             if (self.checkpoints):
                 self.move(time)
         elif (current_node):
             self.current_node = current_node
-            self.current_node.agents.append(self)
+            self.current_node.add_agent(self)
         
         if (self.current_node == self.destination.node):
             self.arrived_at_destination(time, compliance_rate)
@@ -195,7 +302,7 @@ class Agent:
         self.arrival_time = time
         self.current_establishment = self.destination
         self.current_establishment.add_agent(self)
-        self.current_node.agents.remove(self)
+        self.current_node.remove_agent(self)
         self.current_node = None
         if (isinstance(self.destination, Firm)):
             if (isinstance(self, WorkingAgent) and self.destination == self.firm):
@@ -261,32 +368,43 @@ class Agent:
         current_checkpoint = self.checkpoints[0]
 
         if (current_checkpoint.mode == 'walk'):
-            self.current_node.agents.remove(self)
+            self.current_node.remove_agent(self)
             self.current_node = None
             
             if (current_checkpoint.start_node == current_checkpoint.end_node):
                 walking_time = 5
             else:
-                total_distance = sum(edge.distance for edge in shortest_edge_path(current_checkpoint.start_node.id, current_checkpoint.end_node.id, self.city, self.railway))
+                total_distance = self.city.distances.distance(current_checkpoint.start_node.id, current_checkpoint.end_node.id)
                 walking_time = math.ceil(total_distance / 75)  # Assuming walking speed is 1 unit per time
             self.set_state('travelling')
             manager.emit(time + walking_time + config.get("TIME_STEP", 2), manager.Event(manager.AGENT_ARRIVAL, self))
         elif (current_checkpoint.mode == 'ride'):
             self.set_state('waiting')
+            self.current_node.wait(self, current_checkpoint.end_node)
 
 class WorkingAgent(Agent):
-    firm:Firm = None
-    errand_run:bool = False
-    finished_work:bool = False
-    weekend_worker:bool = False
+    __slots__ = ('_firm', 'errand_run', 'finished_work', 'weekend_worker', 'day_offs', 'clocked_in', 'working_hours')
     day_offs:list[int]
-    clocked_in:bool = False
 
     def __init__(self, age:int, city:RegionGraph, railway:Graph, household:Household, working_hours:tuple[int, int], compartment:str = 'S'):
         super().__init__(age, city, railway, household, compartment)
+        self._firm = None
+        self.errand_run = False
+        self.finished_work = False
+        self.weekend_worker = False
+        self.clocked_in = False
         self.working_hours = working_hours
         self.day_offs = []
 
+    @property
+    def firm(self) -> Firm:
+        return self._firm
+
+    @firm.setter
+    def firm(self, firm:Firm):
+        self._firm = firm
+        Agent.table.firm[self.row] = firm.id if firm else -1
+
 
 def handle_agent_events(event:manager.Event, time:int, simulation):
     agents:list[Agent] = event.get_objects()
@@ -313,6 +431,8 @@ def handle_agent_events(event:manager.Event, time:int, simulation):
             current_location = agent.current_establishment
             if (current_location):
                 current_location.sync_agent_state(agent, "I")
+            if (agent.transportation):
+                agent.transportation.sync_agent_state(agent, "I")
     elif (event.type == manager.AGENT_IMMUNITY_LOSS):
         LOGGER.debug(f'Handling agent immunity loss for {len(agents)} agents at time {time}.')
         for agent in agents:
@@ -322,6 +442,8 @@ def handle_agent_events(event:manager.Event, time:int, simulation):
                 current_location = agent.current_establishment
                 if (current_location):
                     current_location.sync_agent_state(agent, "R")
+                if (agent.transportation):
+                    agent.transportation.sync_agent_state(agent, "R")
     elif (event.type == manager.AGENT_INFECTED):
         for agent in agents:
             agent.SEIR_compartment = 'I'
@@ -342,6 +464,8 @@ def handle_agent_events(event:manager.Event, time:int, simulation):
             current_location = agent.current_establishment
             if (current_location):
                 current_location.sync_agent_state(agent, "E")
+            if (agent.transportation):
+                agent.transportation.sync_agent_state(agent, "E")
             
             remove_event = manager.Event(manager.AGENT_REMOVED, agent)
             manager.emit(time + round(simulation.disease.sample_infected_duration()), remove_event)
@@ -355,22 +479,17 @@ def handle_agent_events(event:manager.Event, time:int, simulation):
     elif (event.type == manager.AGENT_GO_SHOPPING):
         LOGGER.debug(f"Handling agent go shopping for {len(agents)} agents at time {time}.")
         for agent in agents:
+            excluded = agent.firm if isinstance(agent, WorkingAgent) else None
             if (random.random() < 0.8):
-                choices:list[Firm] = [firm for firm in agent.city.get_close_firms(agent.current_establishment.region) if firm.working_agents]
+                destination = agent.city.choose_close_firm(agent.current_establishment.region, excluded)
             else:
-                choices:list[Firm] = [firm for firm in agent.city.get_firms() if firm.working_agents]
-            if (isinstance(agent, WorkingAgent) and agent.firm in choices):
-                choices.remove(agent.firm)
-            if (not choices):
+                destination = agent.city.choose_firm(excluded)
+            if (not destination):
                 continue
-            destination = random.choice(choices)
             if (simulation.max_travel_distance):
-                distance = sum(edge.distance for edge in shortest_edge_path(agent.current_establishment.node.id, destination.node.id, agent.city, agent.railway))
+                distance = agent.city.distances.distance(agent.current_establishment.node.id, destination.node.id)
                 if (distance > simulation.max_travel_distance and random.random() < simulation.distance_compliance):
-                    choices:list[Firm] = [firm for firm in agent.city.get_close_firms(agent.current_establishment.region) if firm.working_agents]
-                    if (isinstance(agent, WorkingAgent) and agent.firm in choices):
-                        choices.remove(agent.firm)
-                    destination = random.choice(choices)
+                    destination = agent.city.choose_close_firm(agent.current_establishment.region, excluded) or destination
 
 
             if (agent.commuting):
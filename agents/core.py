@@ -39,6 +39,7 @@ class Establishment:
     no_infected_agents:float = 0
     max_contact_rate:float = 10.0
     max_capacity:int = 100
+    active:dict['Establishment', None] = {}
 
     def __init__(self, node, region, max_capacity, max_contact_rate):
         self.node = node
@@ -61,6 +62,14 @@ class Establishment:
             self.infected_agents.add(agent)
         elif (agent.SEIR_compartment == 'S'):
             self.susceptible_agents.add(agent)
+        self.update_activity()
+
+    def update_activity(self):
+        """Keeps the establishment in its class's active index while it has both susceptible and infected agents"""
+        if (self.susceptible_agents and self.no_infected_agents != 0):
+            self.active[self] = None
+        else:
+            self.active.pop(self, None)
 
     def sync_agent_state(self, agent, old_compartment: str):
         """Called by the agent whenever their SEIR state changes while inside this establishment."""
@@ -80,6 +89,7 @@ class Establishment:
 
         if (self.no_infected_agents < 1e-9):
             self.no_infected_agents = 0.0
+        self.update_activity()
     
     def remove_agent(self, agent):
         self.no_agents -= 1
@@ -96,6 +106,7 @@ class Establishment:
             self.no_infected_agents = 0
         elif (self.no_infected_agents < 1e-9):
             self.no_infected_agents = 0
+        self.update_activity()
     
     def contact_rate(self) -> float:
         if (self.base_capacity == 0):
@@ -109,6 +120,8 @@ class Establishment:
 
 
 class Household(Establishment):
+    active:dict['Household', None] = {}
+
     def __init__(self, node, region, max_contact_rate:float):
         resident_count = generate_resident_count()
         super().__init__(node, region, resident_count, max_contact_rate)
@@ -124,6 +137,7 @@ class Firm(Establishment):
     day_workers:dict[int, list]
     max_workers:int
     testing_probability:float = 0
+    active:dict['Firm', None] = {}
     
     def __init__(self, node, region, size:Literal['micro', 'small', 'medium', 'large'], max_contact_rate:float):
         if (size == 'micro'):
@@ -149,8 +163,12 @@ class Firm(Establishment):
         super().add_agent(agent)
         if (agent in self.resident_agents):
             self.working_agents.append(agent)
+            if (len(self.working_agents) == 1):
+                self.region.open_firm(self)
     
     def remove_agent(self, agent):
         super().remove_agent(agent)
         if (agent in self.resident_agents and agent in self.working_agents):
             self.working_agents.remove(agent)
+            if (not self.working_agents):
+                self.region.close_firm(self)
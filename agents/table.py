@@ -0,0 +1,99 @@
+import numpy as np
+import logging
+import tempfile
+import os
+
+LOGGER = logging.getLogger('AgentTable')
+
+COMPARTMENTS = ('S', 'E', 'I', 'R', 'D')
+STATES = ('home', 'travelling', 'waiting', 'working', 'consuming')
+COMPARTMENT_CODES = {compartment:code for code, compartment in enumerate(COMPARTMENTS)}
+STATE_CODES = {state:code for code, state in enumerate(STATES)}
+
+COLUMNS = {
+    'compartment':np.int8, 'state':np.int8, 'age':np.int16,
+    'household':np.int32, 'firm':np.int32,
+    'isolate':np.bool_, 'masked':np.bool_, 'infection_multiplier':np.float32
+}
+DEFAULTS = {'household':-1, 'firm':-1, 'infection_multiplier':1.0}
+
+
+class AgentTable:
+    """Struct-of-arrays store for the per-agent fields that population-wide passes read.
+    Row i belongs to the i-th agent created while this table is the active Agent.table."""
+    size:int = 0
+    capacity:int = 0
+    compartment:np.ndarray
+    state:np.ndarray
+    age:np.ndarray
+    household:np.ndarray
+    firm:np.ndarray
+    isolate:np.ndarray
+    masked:np.ndarray
+    infection_multiplier:np.ndarray
+
+    def __init__(self, capacity:int=1024, memmap:bool=False, memmap_dir:str|None=None):
+        self.memmap_dir = None
+        if (memmap):
+            self.memmap_dir = memmap_dir or tempfile.mkdtemp(prefix='agent-table-')
+            os.makedirs(self.memmap_dir, exist_ok=True)
+            LOGGER.info(f'Backing agent table with memory-mapped files in {self.memmap_dir}')
+        self.reserve(capacity)
+
+    def _allocate(self, name:str, dtype, capacity:int) -> np.ndarray:
+        if (not self.memmap_dir):
+            return np.empty(capacity, dtype=dtype)
+        return np.memmap(os.path.join(self.memmap_dir, f'{name}.{capacity}.dat'), dtype=dtype, mode='w+', shape=(capacity,))
+
+    def reserve(self, capacity:int):
+        if (capacity <= self.capacity):
+            return
+
+        for name, dtype in COLUMNS.items():
+            column = self._allocate(name, dtype, capacity)
+            column[self.size:] = DEFAULTS.get(name, 0)
+            if (self.size):
+                column[:self.size] = getattr(self, name)[:self.size]
+            self._release(name)
+            setattr(self, name, column)
+        self.capacity = capacity
+
+    def _release(self, name:str):
+        # The mapping stays valid for any outstanding views after the file is unlinked
+        column = getattr(self, name, None)
+        if (isinstance(column, np.memmap) and column.filename and os.path.exists(column.filename)):
+            os.remove(column.filename)
+
+    def __getstate__(self) -> dict:
+        """Only the used rows are pickled. Columns are reallocated on load, memory-mapped again if they were."""
+        return {'size':self.size, 'memmap':self.memmap_dir is not None, 'columns':{name:np.array(self.view(name)) for name in COLUMNS}}
+
+    def __setstate__(self, state:dict):
+        self.size = 0
+        self.capacity = 0
+        self.memmap_dir = tempfile.mkdtemp(prefix='agent-table-') if state['memmap'] else None
+        self.reserve(max(1024, state['size']))
+        for name, values in state['columns'].items():
+            getattr(self, name)[:len(values)] = values
+        self.size = state['size']
+
+    def append(self) -> int:
+        if (self.size >= self.capacity):
+            self.reserve(max(1024, self.capacity * 2))
+        row = self.size
+        self.size += 1
+        return row
+
+    def view(self, name:str) -> np.ndarray:
+        return getattr(self, name)[:self.size]
+
+    def compartment_counts(self) -> dict[str, int]:
+        counts = np.bincount(self.view('compartment'), minlength=len(COMPARTMENTS))
+        return {compartment:int(count) for compartment, count in zip(COMPARTMENTS, counts)}
+
+    def state_counts(self) -> dict[str, int]:
+        counts = np.bincount(self.view('state'), minlength=len(STATES))
+        return {state:int(count) for state, count in zip(STATES, counts) if count}
+
+    def rows_in_state(self, state:str) -> np.ndarray:
+        return np.flatnonzero(self.view('state') == STATE_CODES[state])
@@ -0,0 +1,152 @@
+import configuration as config
+from graphing.mapping import load_compiled_map, build_environment, MAP_PATH, RESIDENTIAL_UNIT_RATIO
+from graphing.distance import load_distance_table
+from time import perf_counter
+import numpy as np
+import random
+import math
+
+"""Benchmark cases. Each takes the target population (None for population independent cases) and returns
+a dict of metrics, timings in seconds. Seeds are fixed so every run builds the same world."""
+MEAN_HOUSEHOLD_SIZE = 3.78
+
+
+def seed():
+    random.seed(config.get('BENCHMARK_SEED', 0))
+    np.random.seed(config.get('BENCHMARK_SEED', 0))
+
+
+def peak_rss_mb() -> float:
+    """High-water mark of this process' resident set, which starts fresh in every spawned case process"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if (line.startswith('VmHWM:')):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    import resource
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def scaled_map(population:int | None) -> dict[str, np.ndarray]:
+    """The compiled map with its residential and business units scaled so the generated population is close to
+    population. Firms scale with households so every worker can still be placed."""
+    compiled = load_compiled_map(config.get('MAP_PATH', MAP_PATH))
+    if (population is None):
+        return compiled
+    residential = sum(math.ceil(units * RESIDENTIAL_UNIT_RATIO) for units in compiled['region_units'][:, 0].tolist())
+    factor = population / (residential * MEAN_HOUSEHOLD_SIZE)
+    compiled = dict(compiled)
+    compiled['region_units'] = compiled['region_units'] * factor
+    return compiled
+
+
+def load_environment(population:int | None) -> tuple:
+    compiled = scaled_map(population)
+    environment = build_environment(compiled)
+    environment[0].distances = load_distance_table(environment[0])
+    return environment
+
+
+def bench_load_graph(population:int | None) -> dict:
+    seed()
+    start = perf_counter()
+    compiled = scaled_map(population)
+    compiled_time = perf_counter() - start
+    environment = build_environment(compiled)
+    build_time = perf_counter() - start - compiled_time
+    load_distance_table(environment[0])
+    return {
+        'total_s':perf_counter() - start, 'compiled_map_s':compiled_time, 'build_environment_s':build_time,
+        'households':len(environment[0].get_households()), 'firms':len(environment[0].get_firms())
+        }
+
+
+def bench_routing_build(population:int | None) -> dict:
+    """Runs the routing cache worker over a fixed sample of origins in-process and extrapolates the full build"""
+    import routing_table
+    seed()
+    city, _, _ = load_environment(population)
+    establishments = city.get_firms() + city.get_households()
+    origins = sorted(set(establishment.node.id for establishment in establishments))
+    routing_table.init_worker(origins)
+    sample = random.Random(config.get('BENCHMARK_SEED', 0)).sample(origins, min(len(origins), config.get('BENCHMARK_ROUTING_ORIGINS', 20)))
+
+    start = perf_counter()
+    paths = 0
+    for origin in sample:
+        paths += len(routing_table.compute_paths_from(origin))
+    elapsed = perf_counter() - start
+    return {
+        'sample_s':elapsed, 'per_origin_s':elapsed / len(sample), 'estimated_build_s':elapsed / len(sample) * len(origins),
+        'origins':len(origins), 'sampled_paths':paths
+        }
+
+
+def bench_manager(population:int | None) -> dict:
+    """One day of events for every agent, a tenth of them cancelled, drained tick by tick"""
+    import manager
+    seed()
+    manager.init()
+    time_step = config.get('TIME_STEP', 2)
+    count = population or 100000
+    targets = [object() for _ in range(count)]
+    event_types = [manager.AGENT_GO_WORK, manager.AGENT_GO_HOME, manager.AGENT_ARRIVAL, manager.AGENT_GO_SHOPPING]
+    times = np.random.randint(0, 60 * 24, count).tolist()
+    types = np.random.randint(0, len(event_types), count).tolist()
+
+    start = perf_counter()
+    for target, time, type in zip(targets, times, types):
+        manager.emit(time, manager.Event(event_types[type], target))
+    emit_time = perf_counter() - start
+
+    start = perf_counter()
+    for i in range(0, count, 10):
+        manager.cancel(event_types[types[i]], targets[i])
+    cancel_time = perf_counter() - start
+
+    start = perf_counter()
+    handled = 0
+    time = 0
+    while (manager.next_time() is not None):
+        for event in manager.get(time):
+            handled += len(event.get_objects())
+        time += time_step
+    get_time = perf_counter() - start
+    return {'emit_s':emit_time, 'cancel_s':cancel_time, 'get_s':get_time, 'events':count, 'handled':handled}
+
+
+def bench_day(population:int | None) -> dict:
+    """Full headless simulated days with profiling on. The infection routine figures come from the same run."""
+    import profiling
+    from simulation import Simulation
+    from results import MemorySink
+    seed()
+    environment = load_environment(population)
+    seed()
+    start = perf_counter()
+    simulation = Simulation(True, environment=environment, result_sink=MemorySink())
+    total = perf_counter() - start
+    days = [seconds for _, seconds in profiling.day_times]
+    infection_calls, _, infection_ns, _ = profiling.routine_stats.get('infection', [1, 0, 0, 0])
+    return {
+        'total_s':total, 'init_s':total - sum(days), 'day_s':sum(days) / max(len(days), 1),
+        'infection_routine_ms':infection_ns / infection_calls / 1e6, 'agents':len(simulation.agents), 'days':len(days)
+        }
+
+
+# Case name -> (function, whether it runs at every population scale)
+CASES = {
+    'load_graph':(bench_load_graph, True),
+    'routing_build':(bench_routing_build, False),
+    'manager':(bench_manager, True),
+    'day':(bench_day, True),
+    }
+
+
+def run_case(name:str, population:int | None) -> dict:
+    function, _ = CASES[name]
+    metrics = function(population)
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return {key:(round(value, 4) if isinstance(value, float) else value) for key, value in metrics.items()}
@@ -0,0 +1,139 @@
+from dotenv import load_dotenv
+load_dotenv()
+import configuration as config
+from benchmarks import cases
+from datetime import datetime
+import multiprocessing
+import platform
+import tempfile
+import logging
+import json
+import sys
+import os
+
+LOGGER = logging.getLogger('Benchmark')
+
+"""Offline benchmark suite, run from the repository root with `python -m benchmarks.run`. Every case runs in
+its own spawned process with fixed seeds and no result sink other than an in-memory one, so no Firestore access
+is needed. Results are written to BENCHMARK_OUTPUT and compared against BENCHMARK_BASELINE; metrics ending in
+_s, _ms or _mb that grew by more than BENCHMARK_TOLERANCE are reported as regressions. A failed case, a metric missing
+from a case the baseline has or any regression makes the suite exit with 1, and a failed run is never saved as baseline."""
+DEFAULT_SCALES = [10000, 100000, 1000000]
+COMPARED_SUFFIXES = ('_s', '_ms', '_mb')
+
+
+def _case_process(connection, name:str, population:int | None):
+    config.init()
+    try:
+        connection.send(cases.run_case(name, population))
+    except Exception as e:
+        connection.send({'error':repr(e)})
+    connection.close()
+
+
+def run_case(name:str, population:int | None) -> dict:
+    """Spawned rather than forked so imports, caches and the RSS high-water mark start clean for every case"""
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_case_process, args=(sender, name, population))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if (result is None):
+        result = {'error':f'case process exited with code {process.exitcode}'}
+    return result
+
+
+def run_suite() -> dict:
+    scales = config.get('BENCHMARK_SCALES', DEFAULT_SCALES)
+    results = {}
+    for name in config.get('BENCHMARK_CASES', list(cases.CASES)):
+        _, scaled = cases.CASES[name]
+        for population in (scales if scaled else [None]):
+            key = name if (population is None) else f'{name}@{population}'
+            LOGGER.info(f'Running {key}...')
+            results[key] = run_case(name, population)
+            LOGGER.info(f'{key}: {results[key]}')
+    return results
+
+
+def compare(results:dict, baseline:dict, tolerance:float) -> list[str]:
+    """Prints every comparable metric next to its baseline and returns the ones that regressed"""
+    regressions = []
+    print(f"{'case':<24} {'metric':<24} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get(key, {}).get(metric)
+            if (not metric.endswith(COMPARED_SUFFIXES) or not previous):
+                continue
+            change = value / previous - 1
+            regressed = change > tolerance
+            print(f"{key:<24} {metric:<24} {previous:>12} {value:>12} {change:>+9.1%}{'  REGRESSION' if regressed else ''}")
+            if (regressed):
+                regressions.append(f'{key} {metric}')
+    return regressions
+
+
+def missing_metrics(results:dict, baseline:dict) -> list[str]:
+    """Metrics the baseline has but a case that ran without an error no longer reports"""
+    missing = []
+    for key, metrics in results.items():
+        if ('error' in metrics):
+            continue
+        missing.extend(f'{key} {metric}' for metric in baseline.get(key, {}) if metric not in metrics)
+    return missing
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    config.init()
+
+    """Simulation reloads the config file itself, so cases get the benchmark settings through an overlay file.
+    Scenario forking, checkpoints and the population cache are switched off to keep the timings comparable."""
+    overlay = {
+        'DURATION':config.get('BENCHMARK_DAYS', 1), 'PROFILE':True, 'PROFILE_DAY':None,
+        'PROFILE_OUTPUT':os.path.join(tempfile.gettempdir(), 'benchmark_profile.json'),
+        'SCENARIOS':None, 'SNAPSHOT_INTERVAL_DAYS':None, 'POPULATION_CACHE':None
+        }
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump({**config.__config, **overlay}, f)
+    os.environ['CONFIG_FILE_NAME'] = f.name
+    os.environ['CLOUD'] = 'False'
+
+    try:
+        results = run_suite()
+    finally:
+        os.remove(f.name)
+
+    report = {'created':datetime.now().isoformat(), 'python':platform.python_version(), 'machine':platform.machine(), 'results':results}
+    with open(config.get('BENCHMARK_OUTPUT', 'benchmark.json'), 'w') as output:
+        json.dump(report, output, indent=2)
+
+    errors = [f"{key} ({metrics['error']})" for key, metrics in results.items() if 'error' in metrics]
+    if (errors):
+        LOGGER.error(f'{len(errors)} cases failed: {", ".join(errors)}')
+
+    baseline_path = config.get('BENCHMARK_BASELINE', os.path.join('benchmarks', 'baseline.json'))
+    if (config.get('BENCHMARK_SAVE_BASELINE', False) or not os.path.exists(baseline_path)):
+        if (errors):
+            LOGGER.error(f'Baseline not saved to {baseline_path} because some cases failed.')
+            sys.exit(1)
+        with open(baseline_path, 'w') as output:
+            json.dump(report, output, indent=2)
+        LOGGER.info(f'Baseline saved to {baseline_path}')
+        sys.exit(0)
+
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline['results'], config.get('BENCHMARK_TOLERANCE', 0.1))
+    if (regressions):
+        LOGGER.error(f'{len(regressions)} regressions against {baseline_path}: {", ".join(regressions)}')
+    missing = missing_metrics(results, baseline['results'])
+    if (missing):
+        LOGGER.error(f'{len(missing)} metrics of {baseline_path} are missing: {", ".join(missing)}')
+    if (errors or regressions or missing):
+        sys.exit(1)
@@ -1,148 +1,161 @@
+from dotenv import load_dotenv
+load_dotenv()
+import configuration as config
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from results import DAILY_COLUMNS
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 import matplotlib.pyplot as plt
-import math
-from dotenv import load_dotenv
+import pandas as pd
+import numpy as np
+import sqlite3
+import json
 import os
 
 
-class DataPoint:
-    susceptible:int
-    exposed:int
-    infected:int
-    removed:int
-    dead:int
-    time:int
-
-    def __init__(self, time, data:dict):
-        self.susceptible = data["S"]
-        self.exposed = data["E"]
-        self.infected = data["I"]
-        self.removed = data["R"]
-        self.dead = data["D"]
-        self.time = time
-
-class DataPointAverage:
-    _susceptible:list[int]
-    _exposed:list[int]
-    _infected:list[int]
-    _removed:list[int]
-    _dead:list[int]
-
-    def __init__(self, point:DataPoint):
-        self._susceptible = [point.susceptible]
-        self._exposed = [point.exposed]
-        self._infected = [point.infected]
-        self._removed = [point.removed]
-        self._dead = [point.dead]
-    
-    def add_point(self, point:DataPoint):
-        self._susceptible.append(point.susceptible)
-        self._exposed.append(point.exposed)
-        self._infected.append(point.infected)
-        self._removed.append(point.removed)
-        self._dead.append(point.dead)
-    
-    @property
-    def susceptible(self):
-        if (not self._susceptible):
-            return 0
-
-        return sum(self._susceptible)/len(self._susceptible)
-
-    @property
-    def exposed(self):
-        if (not self._exposed):
-            return 0
-        
-        return sum(self._exposed)/len(self._exposed)
-
-    @property
-    def infected(self):
-        if (not self._infected):
-            return 0
-        
-        return sum(self._infected)/len(self._infected)
-
-    @property
-    def removed(self):
-        if (not self._removed):
-            return 0
-        
-        return sum(self._removed)/len(self._removed)
-
-    @property
-    def dead(self):
-        if (not self._dead):
-            return 0
-        
-        return sum(self._dead)/len(self._dead)
+CACHE_DIR = '.results_cache'
+FETCH_WORKERS = 8
+FETCH_CHUNK_SIZE = 50
+COMPARTMENTS = ['S', 'E', 'I', 'R', 'D']
+PERCENTILES = (0.05, 0.95)
+CONFIDENCE_Z = 1.96
+
+
+def load_cache(collection_id:str) -> dict[str, dict]:
+    path = os.path.join(CACHE_DIR, f'{collection_id}.json')
+    if (not os.path.exists(path)):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(collection_id:str, cache:dict[str, dict]):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = os.path.join(CACHE_DIR, f'{collection_id}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(cache, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def fetch_simulations(db, collection, cache:dict[str, dict]) -> dict[str, dict]:
+    """Brings the cache up to date with the collection. An empty field projection lists every document with its
+    update time without downloading the payloads, so only new or changed simulations are fetched, in concurrent
+    batched reads."""
+    update_times = {snapshot.id:str(snapshot.update_time) for snapshot in collection.select([]).stream()}
+    for sim_id in list(cache):
+        if (sim_id not in update_times):
+            del cache[sim_id]
+
+    stale = [collection.document(sim_id) for sim_id, update_time in update_times.items() if (cache.get(sim_id, {}).get('update_time') != update_time)]
+    print(f"{len(update_times)} simulations, {len(stale)} to download")
+    chunks = [stale[i:i + FETCH_CHUNK_SIZE] for i in range(0, len(stale), FETCH_CHUNK_SIZE)]
+    with ThreadPoolExecutor(FETCH_WORKERS) as executor:
+        for snapshots in executor.map(lambda chunk: list(db.get_all(chunk)), chunks):
+            for snapshot in snapshots:
+                cache[snapshot.id] = {'update_time':str(snapshot.update_time), 'data':snapshot.to_dict() or {}}
+    return cache
+
+
+def to_frame(cache:dict[str, dict]) -> pd.DataFrame:
+    """One row per simulation and day with a column per compartment"""
+    records = [
+        (sim_id, int(day), *(data.get(compartment, 0) for compartment in COMPARTMENTS))
+        for sim_id, entry in cache.items() for day, data in entry['data'].items()
+        ]
+    frame = pd.DataFrame.from_records(records, columns=['simulation', 'day'] + COMPARTMENTS)
+    return frame.sort_values(['simulation', 'day'], ignore_index=True)
+
+
+def read_local_results(kind:str, path:str) -> pd.DataFrame:
+    """Daily rows of every csv, parquet or sqlite result sink under path, including the per-scenario directories
+    of forked runs"""
+    if (kind not in ('csv', 'parquet', 'sqlite')):
+        raise ValueError(f"Result sink '{kind}' has no local files to read")
+    frames = []
+    for directory, _, files in os.walk(path):
+        if (kind == 'sqlite' and 'results.db' in files):
+            with closing(sqlite3.connect(os.path.join(directory, 'results.db'))) as connection:
+                frames.append(pd.read_sql_query('SELECT * FROM daily', connection))
+        elif (kind == 'csv' and 'daily.csv' in files):
+            frames.append(pd.read_csv(os.path.join(directory, 'daily.csv')))
+        elif (kind == 'parquet' and os.path.basename(directory) == 'daily' and files):
+            frames.append(pd.read_parquet(directory))
+    if (not frames):
+        return pd.DataFrame(columns=DAILY_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def local_frame(rows:pd.DataFrame, collection_id:str) -> pd.DataFrame:
+    """Same frame as to_frame, from the daily rows of one collection. The csv and parquet sinks append, so a day
+    written twice keeps its last row like a merged Firestore document."""
+    rows = rows[rows['collection'] == collection_id].drop_duplicates(['simulation', 'day'], keep='last')
+    rows = rows.astype({'day':int})
+    return rows[['simulation', 'day'] + COMPARTMENTS].sort_values(['simulation', 'day'], ignore_index=True)
+
+
+def aggregate(frame:pd.DataFrame) -> pd.DataFrame:
+    """Per-day mean, percentile band and normal-approximation confidence interval of the mean across replicates.
+    Columns are (statistic, compartment)."""
+    grouped = frame.groupby('day')[COMPARTMENTS]
+    mean = grouped.mean()
+    half_width = CONFIDENCE_Z * grouped.std().fillna(0) / np.sqrt(grouped.count())
+    return pd.concat({
+        'mean':mean,
+        'low':grouped.quantile(PERCENTILES[0]),
+        'high':grouped.quantile(PERCENTILES[1]),
+        'ci_low':mean - half_width,
+        'ci_high':mean + half_width,
+        }, axis=1)
 
 
 if __name__ == "__main__":
-    load_dotenv()
-    cred = credentials.Certificate(os.environ['CERT_FILE_NAME'])
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    sim_groups = db.collections()
-    sim_groups_dict = {}
-
-    for i, sim_group in enumerate(sim_groups):
-        print(f'[{i}] {sim_group.id}')
-        sim_groups_dict[i] = sim_group.id
-    simulation_group = int(input("Enter the simulation group name: "))
-    
-    collection = db.collection(sim_groups_dict[simulation_group])
-    docs = collection.list_documents()
+    config.init()
+    sink_kind = config.get('RESULT_SINK', 'firestore')
+    if (sink_kind == 'firestore'):
+        cred = credentials.Certificate(os.environ['CERT_FILE_NAME'])
+        firebase_admin.initialize_app(cred)
+        db = firestore.client()
+        sim_groups = db.collections()
+        sim_groups_dict = {}
+
+        for i, sim_group in enumerate(sim_groups):
+            print(f'[{i}] {sim_group.id}')
+            sim_groups_dict[i] = sim_group.id
+        simulation_group = int(input("Enter the simulation group name: "))
+
+        collection = db.collection(sim_groups_dict[simulation_group])
+        collection_id = collection.id
+        cache = fetch_simulations(db, collection, load_cache(collection_id))
+        save_cache(collection_id, cache)
+        frame = to_frame(cache)
+    else:
+        rows = read_local_results(sink_kind, config.get('RESULT_PATH', 'results'))
+        collection_ids = sorted(rows['collection'].unique())
+        for i, collection_id in enumerate(collection_ids):
+            print(f'[{i}] {collection_id}')
+        collection_id = collection_ids[int(input("Enter the simulation group name: "))]
+        frame = local_frame(rows, collection_id)
+
+    summary = aggregate(frame)
+    print(summary.round(2).to_string())
 
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 5))
-    fig.canvas.manager.set_window_title(collection.id)
-
-    average_cases:dict[int, DataPointAverage] = {}
-    
-    for sim in docs:
-        print(f"Simulation ID: {sim.id}")
-        sim_ref = collection.document(sim.id)
-        sim_data = sim_ref.get().to_dict()
-        active_cases:list[DataPoint] = []
-        for time, data in sim_data.items():
-            active_cases.append(DataPoint(int(time), data))
-        
-        active_cases.sort(key=lambda d: d.time)
-
-        x_active = []
-        y_active = []
-
-        for case in active_cases:
-            x_active.append(case.time)
-            y_active.append(case.infected)
-            if (case.time not in average_cases):
-                average_cases[case.time] = DataPointAverage(case)
-            else:
-                average_cases[case.time].add_point(case)
-        ax1.plot(x_active, y_active, marker='o', linestyle='-', label=sim.id)
-    
-    ave_x = list(average_cases.keys())
-
-    ave_y = [dailyAverage.exposed for dailyAverage in average_cases.values()]
-    ax2.plot(ave_x, ave_y, label="Exposed")
-
-    ave_y = [dailyAverage.infected for dailyAverage in average_cases.values()]
-    ax2.plot(ave_x, ave_y, label="Infected")
-
-    ave_y = [dailyAverage.removed for dailyAverage in average_cases.values()]
-    ax2.plot(ave_x, ave_y, label="Removed")
-
-
-
-    # --- Graph 2: Line Chart ---
-    # Adding a marker 'o' makes the data points clearly visible on the line
+    fig.canvas.manager.set_window_title(collection_id)
+
+    active_cases = frame.pivot(index='day', columns='simulation', values='I')
+    ax1.plot(active_cases.index, active_cases.to_numpy(), marker='o', linestyle='-')
+
+    for compartment, label in (('E', 'Exposed'), ('I', 'Infected'), ('R', 'Removed')):
+        line, = ax2.plot(summary.index, summary['mean', compartment], label=label)
+        ax2.fill_between(summary.index, summary['low', compartment], summary['high', compartment], color=line.get_color(), alpha=0.2)
+
     ax1.set_title('Simulation Disease Spread (Line)')
     ax1.set_ylabel('Active Cases')
     ax1.set_xlabel('Days')
 
-    ax2.set_title('Average Simulation Disease Spread (Line)')
+    ax2.set_title(f'Average Simulation Disease Spread ({PERCENTILES[0]:.0%}-{PERCENTILES[1]:.0%} band)')
     ax2.set_ylabel('Active Cases')
     ax2.set_xlabel('Days')
     ax2.legend()
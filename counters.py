@@ -0,0 +1,84 @@
+from agents.table import COMPARTMENTS, STATES
+
+"""Population-wide tallies kept up to date at every transition so that metric reads never scan agents or vehicles.
+Agents feed compartments, states and travel modes through their property setters; routed vehicles feed
+their counts and loads when they spawn, despawn, board, alight or drop external passengers."""
+compartments:dict[str, int] = {compartment:0 for compartment in COMPARTMENTS}
+states:dict[str, int] = {state:0 for state in STATES}
+travel_modes:dict[str, int] = {}
+vehicles:dict[str, int] = {}
+vehicle_loads:dict[str, dict[int, int]] = {}
+
+
+def reset():
+    for compartment in COMPARTMENTS:
+        compartments[compartment] = 0
+    for state in STATES:
+        states[state] = 0
+    travel_modes.clear()
+    vehicles.clear()
+    vehicle_loads.clear()
+
+
+def add_agent(compartment:str, state:str):
+    compartments[compartment] += 1
+    states[state] += 1
+
+
+def change_compartment(old:str, new:str):
+    compartments[old] -= 1
+    compartments[new] += 1
+
+
+def change_state(old:str, new:str):
+    states[old] -= 1
+    states[new] += 1
+
+
+def change_travel_mode(old:str | None, new:str | None):
+    """Modes are the vehicle method or 'walking'; None means the agent is not travelling"""
+    if (old is not None):
+        travel_modes[old] -= 1
+    if (new is not None):
+        travel_modes[new] = travel_modes.get(new, 0) + 1
+
+
+def add_vehicle(method:str, max_passenger:int, load:int):
+    vehicles[method] = vehicles.get(method, 0) + 1
+    change_load(method, max_passenger, load)
+
+
+def remove_vehicle(method:str, max_passenger:int, load:int):
+    vehicles[method] -= 1
+    change_load(method, max_passenger, -load)
+
+
+def change_load(method:str, max_passenger:int, delta:int):
+    """Loads are summed per vehicle size so that average occupancy stays exact"""
+    loads = vehicle_loads.setdefault(method, {})
+    loads[max_passenger] = loads.get(max_passenger, 0) + delta
+
+
+def compartment_counts() -> dict[str, int]:
+    return dict(compartments)
+
+
+def state_counts() -> dict[str, int]:
+    return {state:count for state, count in states.items() if count}
+
+
+def travel_mode_counts() -> dict[str, int]:
+    return {mode:count for mode, count in travel_modes.items() if count}
+
+
+def vehicle_counts() -> dict[str, int]:
+    return {method:count for method, count in vehicles.items() if count}
+
+
+def average_occupancy() -> dict[str, float]:
+    occupancies = {}
+    for method, count in vehicles.items():
+        if (count):
+            total = sum(load / max_passenger for max_passenger, load in vehicle_loads[method].items())
+            occupancies[method] = round(total / count, 2)
+    return occupancies
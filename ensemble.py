@@ -0,0 +1,88 @@
+from dotenv import load_dotenv
+load_dotenv()
+import configuration as config
+from graphing.mapping import load_graph
+from routing_table import build_routing_cache
+from simulation import Simulation
+import snapshot
+from agents.table import COMPARTMENTS
+from time import time_ns
+import multiprocessing
+import numpy as np
+import logging
+import random
+import json
+import sys
+import os
+
+LOGGER = logging.getLogger('Ensemble')
+
+"""Warm state loaded once in the parent and inherited copy-on-write by every forked worker"""
+_environment:tuple = None
+_routing_table:dict = None
+_population:dict = None
+
+
+def run_replicate(seed:int) -> list[tuple[int, dict[str, int]]]:
+    random.seed(seed)
+    np.random.seed(seed)
+    simulation = Simulation(True, environment=_environment, routing_table=_routing_table, population=_population)
+    return simulation.seir_history
+
+
+def aggregate(histories:list[list[tuple[int, dict[str, int]]]], duration:int) -> dict:
+    """Per-day SEIR curves across replicates. A replicate that stopped early keeps its last day's counts."""
+    curves = np.zeros((len(histories), duration, len(COMPARTMENTS)))
+    for i, history in enumerate(histories):
+        last = None
+        by_day = dict(history)
+        for day in range(duration):
+            last = by_day.get(day, last)
+            if (last is not None):
+                curves[i, day] = [last[compartment] for compartment in COMPARTMENTS]
+
+    result = {'replicates':len(histories), 'days':list(range(duration)), 'compartments':{}}
+    for index, compartment in enumerate(COMPARTMENTS):
+        values = curves[:, :, index]
+        result['compartments'][compartment] = {
+            'mean':values.mean(axis=0).round(2).tolist(),
+            'std':values.std(axis=0).round(2).tolist(),
+            'p5':np.percentile(values, 5, axis=0).round(2).tolist(),
+            'p95':np.percentile(values, 95, axis=0).round(2).tolist()
+        }
+    return result
+
+
+def run_ensemble(replicates:int, processes:int|None=None, base_seed:int=0) -> dict:
+    global _environment, _routing_table, _population
+
+    start_time = time_ns()
+    """The routing table has to be built on the environment the cached agents live in"""
+    population_path = config.get('POPULATION_CACHE')
+    _population = snapshot.load_population(population_path) if (population_path) else None
+    _environment = _population['environment'] if (_population is not None) else load_graph()
+    city, railway, routes = _environment
+    establishments = city.get_firms()
+    establishments.extend(city.get_households())
+    _routing_table = build_routing_cache(establishments, city, railway, routes)
+    LOGGER.info(f'World loaded in {round((time_ns() - start_time) / (10**9), 2)} seconds. Forking {replicates} replicates...')
+
+    """A replicate changes the world it runs in (residents, firm schedules, node occupancy), so every replicate
+    gets a worker freshly forked from the untouched parent"""
+    seeds = [base_seed + i for i in range(replicates)]
+    with multiprocessing.get_context('fork').Pool(processes, maxtasksperchild=1) as pool:
+        histories = pool.map(run_replicate, seeds, chunksize=1)
+
+    LOGGER.info(f'Ensemble of {replicates} replicates finished in {round((time_ns() - start_time) / (10**9), 2)} seconds.')
+    return aggregate(histories, config.get('DURATION'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(handlers=[logging.FileHandler("logfile.txt", 'w'), logging.StreamHandler(sys.stdout)],
+                        level=logging.DEBUG if os.environ.get('DEBUG', 'False') == 'True' else logging.INFO)
+    config.init()
+    result = run_ensemble(config.get('REPLICATES', 30), config.get('PROCESSES'), config.get('SEED', 0))
+    output_path = config.get('ENSEMBLE_OUTPUT', 'ensemble.json')
+    with open(output_path, 'w') as f:
+        json.dump(result, f)
+    LOGGER.info(f'Aggregated SEIR curves written to {output_path}')
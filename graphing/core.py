@@ -2,24 +2,52 @@ import pygame as pg
 from agents.core import Firm, Household
 import random
 
+_labels:dict[tuple[pg.font.Font, str], pg.Surface] = {}
+
+
+def render_label(font:pg.font.Font, text:str) -> pg.Surface:
+    """Map labels never change, so each one is rendered once per font and reused"""
+    label = _labels.get((font, text))
+    if (label is None):
+        label = _labels[(font, text)] = font.render(text, False, (0, 0, 0))
+    return label
+
 
 class Node:
     radius:int = 10
-    agents:list
+    agents:dict
+    waiting:dict['Node', dict]
     edges:list['Edge']
+    routes:list
     max_agents:int = 200
 
     def __init__(self, x:int, y:int, id:tuple[str, int]):
         self.id = id
         self.edges = []
-        self.agents = []
+        self.routes = []
+        self.agents = {}
+        self.waiting = {}
         self.pos = (x, y)
+
+    def add_agent(self, agent):
+        self.agents[agent] = None
+
+    def remove_agent(self, agent):
+        del self.agents[agent]
+
+    def wait(self, agent, target:'Node'):
+        """Queues agent for a vehicle to target. Entries are validated and dropped lazily when vehicles board."""
+        self.waiting.setdefault(target, {})[agent] = None
     
-    def draw(self, window:pg.Surface, font:pg.font.Font, x_offset:int, y_offset:int):
-        pg.draw.circle(window, (int(255 * min(len(self.agents)/self.max_agents, 1)), 255 - int(255 * min(len(self.agents)/self.max_agents, 1)), 0), (self.pos[0] + x_offset, self.pos[1] + y_offset), self.radius)
-        pg.draw.circle(window, (0, 0, 0), (self.pos[0] + x_offset, self.pos[1] + y_offset), self.radius, 2)
-        text = font.render(str(self.id[1]), False, (0, 0, 0))
-        window.blit(text, text.get_rect(center=(self.pos[0] + x_offset, self.pos[1] + y_offset)))
+    def draw(self, window:pg.Surface, x_offset:int, y_offset:int):
+        """Only the fill follows the crowd at the node; the outline and label are drawn once by draw_label"""
+        load = min(len(self.agents)/self.max_agents, 1)
+        pg.draw.circle(window, (int(255 * load), 255 - int(255 * load), 0), (self.pos[0] + x_offset, self.pos[1] + y_offset), self.radius)
+
+    def draw_label(self, surface:pg.Surface, font:pg.font.Font, x_offset:int, y_offset:int):
+        pg.draw.circle(surface, (0, 0, 0), (self.pos[0] + x_offset, self.pos[1] + y_offset), self.radius, 2)
+        text = render_label(font, str(self.id[1]))
+        surface.blit(text, text.get_rect(center=(self.pos[0] + x_offset, self.pos[1] + y_offset)))
 
 
 class Edge:
@@ -42,17 +70,67 @@ class Edge:
         pg.draw.line(window, (0, 0, 0), (node1_pos[0] + x_offset, node1_pos[1] + y_offset), (node2_pos[0] + x_offset, node2_pos[1] + y_offset), 2)
 
 
+class FirmPool:
+    """Unordered set of firms with O(1) insertion, swap-removal and uniform choice"""
+    firms:list[Firm]
+    positions:dict[Firm, int]
+
+    def __init__(self):
+        self.firms = []
+        self.positions = {}
+
+    def __len__(self) -> int:
+        return len(self.firms)
+
+    def __contains__(self, firm:Firm) -> bool:
+        return firm in self.positions
+
+    def add(self, firm:Firm):
+        if (firm in self.positions):
+            return
+        self.positions[firm] = len(self.firms)
+        self.firms.append(firm)
+
+    def remove(self, firm:Firm):
+        position = self.positions.pop(firm, None)
+        if (position is None):
+            return
+        last = self.firms.pop()
+        if (last is not firm):
+            self.firms[position] = last
+            self.positions[last] = position
+
+    def choice(self) -> Firm:
+        return random.choice(self.firms)
+
+
 class Region:
     id:int = 0
     firms:list[Firm]
     households:list[Household]
+    neighbours:list[tuple['Region', int]]
+    open_firms:FirmPool
+    city_open_firms:FirmPool
     
     def __init__(self, nodes:list[Node]):
         self.nodes = nodes
         self.firms = []
         self.households = []
+        self.neighbours = []
+        self.open_firms = FirmPool()
+        self.city_open_firms = FirmPool()
         self.id = Region.id
         Region.id += 1
+
+    def open_firm(self, firm:Firm):
+        """Called by a firm when its first worker clocks in"""
+        self.open_firms.add(firm)
+        self.city_open_firms.add(firm)
+
+    def close_firm(self, firm:Firm):
+        """Called by a firm when its last worker leaves"""
+        self.open_firms.remove(firm)
+        self.city_open_firms.remove(firm)
     
     def add_firm(self, contact_rate:float):
         connected_nodes = list(filter(lambda node: len(node.edges) > 0, self.nodes))
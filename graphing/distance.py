@@ -0,0 +1,116 @@
+import configuration as config
+from graphing.core import Edge
+from graphing.graph import RegionGraph
+from collections import OrderedDict
+import numpy as np
+import logging
+import heapq
+
+LOGGER = logging.getLogger('Distance')
+
+
+class DistanceTable:
+    """Shortest road distances and next hops for the city road layer, one Dijkstra tree per destination.
+    Trees are grown on first use and the least recently used ones are dropped past max_trees, so memory stays
+    bounded by max_trees * nodes however large the map is.
+    Mirrors shortest_edge_path: only city nodes are traversed, a railway start node leaves through its
+    transfer edges, and a destination that cannot be reached yields an empty path and a distance of 0."""
+
+    def __init__(self, graph:RegionGraph, node_ids:list[tuple[str, int]], max_trees:int=1024):
+        self.node_ids = node_ids
+        self.node_index = {node_id:index for index, node_id in enumerate(node_ids)}
+        self.max_trees = max_trees
+        self.trees:OrderedDict[int, tuple[np.ndarray, np.ndarray]] = OrderedDict()
+        self.neighbours:list[list[tuple[int, float]]] = [[] for _ in node_ids]
+        self.edge_between:dict[tuple[int, int], Edge] = {}
+        self.transfers:dict[tuple[str, int], list[tuple[Edge, int]]] = {}
+        for edge in graph.edges.values():
+            i = self.node_index.get(edge.nodes[0].id)
+            j = self.node_index.get(edge.nodes[1].id)
+            if (i is not None and j is not None):
+                if ((i, j) not in self.edge_between or edge.distance < self.edge_between[(i, j)].distance):
+                    self.edge_between[(i, j)] = self.edge_between[(j, i)] = edge
+            elif (i is not None):
+                self.transfers.setdefault(edge.nodes[1].id, []).append((edge, i))
+            elif (j is not None):
+                self.transfers.setdefault(edge.nodes[0].id, []).append((edge, j))
+        for (i, j), edge in self.edge_between.items():
+            self.neighbours[i].append((j, edge.distance))
+
+    def __getstate__(self):
+        """Trees are rebuilt on demand, so snapshots don't carry them"""
+        state = self.__dict__.copy()
+        state['trees'] = OrderedDict()
+        return state
+
+    def _tree(self, end:int) -> tuple[np.ndarray, np.ndarray]:
+        """Distances to end from every node, and the node to step to from each of them on the way there
+        (-1 when end cannot be reached). Roads are two-way, so a Dijkstra grown from end gives both."""
+        tree = self.trees.get(end)
+        if (tree is not None):
+            self.trees.move_to_end(end)
+            return tree
+
+        distances = [np.inf] * len(self.node_ids)
+        next_hops = [-1] * len(self.node_ids)
+        distances[end] = 0
+        next_hops[end] = end
+        queue = [(0, end)]
+        while queue:
+            distance, node = heapq.heappop(queue)
+            if (distance > distances[node]):
+                continue
+            for neighbour, length in self.neighbours[node]:
+                if (distance + length < distances[neighbour]):
+                    distances[neighbour] = distance + length
+                    next_hops[neighbour] = node
+                    heapq.heappush(queue, (distance + length, neighbour))
+
+        tree = (np.array(distances), np.array(next_hops, dtype=np.int32))
+        self.trees[end] = tree
+        if (len(self.trees) > self.max_trees):
+            self.trees.popitem(last=False)
+        return tree
+
+    def _entry(self, start_id:tuple[str, int], distances:np.ndarray) -> tuple[float, Edge | None, int]:
+        """Cheapest way onto the road layer from start_id, given the distances to the destination"""
+        start = self.node_index.get(start_id)
+        if (start is not None):
+            return (distances[start], None, start)
+        best = (np.inf, None, -1)
+        for edge, city_index in self.transfers.get(start_id, []):
+            distance = edge.distance + distances[city_index]
+            if (distance < best[0]):
+                best = (distance, edge, city_index)
+        return best
+
+    def distance(self, start_id:tuple[str, int], end_id:tuple[str, int]) -> float:
+        end = self.node_index.get(end_id)
+        if (end is None or start_id == end_id):
+            return 0
+        distance = self._entry(start_id, self._tree(end)[0])[0]
+        return float(distance) if distance < np.inf else 0
+
+    def path(self, start_id:tuple[str, int], end_id:tuple[str, int]) -> list[Edge]:
+        end = self.node_index.get(end_id)
+        if (end is None or start_id == end_id):
+            return []
+        distances, next_hops = self._tree(end)
+        distance, entry_edge, current = self._entry(start_id, distances)
+        if (distance == np.inf):
+            return []
+
+        path = [entry_edge] if entry_edge else []
+        while current != end:
+            next_hop = int(next_hops[current])
+            path.append(self.edge_between[(current, next_hop)])
+            current = next_hop
+        return path
+
+
+def load_distance_table(graph:RegionGraph) -> DistanceTable:
+    """Distance table for the city road layer, keeping as many destination trees as fit in DISTANCE_CACHE_MB"""
+    node_ids = [node_id for node_id in graph.nodes.keys()]
+    tree_bytes = max(len(node_ids), 1) * (np.dtype(np.float64).itemsize + np.dtype(np.int32).itemsize)
+    max_trees = max(1, int(config.get('DISTANCE_CACHE_MB', 256) * 2**20 // tree_bytes))
+    return DistanceTable(graph, node_ids, max_trees)
@@ -1,5 +1,6 @@
 import configuration as config
-from graphing.core import Node, Edge, Region
+from graphing.core import Node, Edge, Region, FirmPool
+import random
 from agents.core import Firm, Household
 import pygame as pg
 
@@ -13,6 +14,11 @@ class Graph:
     y_temp_offset:int = None
     y_offset:int = 0
     x_offset:int = 0
+    # Pre-rendered static layers of the current view, rebuilt only when the map is panned or the window resized
+    static_view:tuple = None
+    background:pg.Surface = None
+    overlay:pg.Surface = None
+    visible_nodes:list['Node'] = []
 
     def __init__(self, layer:str):
         self.layer = layer
@@ -68,26 +74,59 @@ class Graph:
             self.y_temp_offset = self.y_offset + (event.pos[1] - self.start_drag[1])
         
 
+    def get_offset(self) -> tuple[int, int]:
+        x_offset = self.x_offset if self.x_temp_offset == None else self.x_temp_offset
+        y_offset = self.y_offset if self.y_temp_offset == None else self.y_temp_offset
+        return (x_offset, y_offset)
+
+    def render_static(self, size:tuple[int, int], font:pg.font.Font, x_offset:int, y_offset:int):
+        """Edges go on an opaque background under the nodes, node outlines and labels on a transparent overlay
+        above them. Nodes outside the view are skipped here and by every frame until the next pan."""
+        self.background = pg.Surface(size)
+        self.background.fill((255, 255, 255))
+        for edge in self.edges.values():
+            edge.draw(self.background, x_offset, y_offset)
+
+        view = pg.Rect(-x_offset - Node.radius, -y_offset - Node.radius, size[0] + 2 * Node.radius, size[1] + 2 * Node.radius)
+        self.visible_nodes = [node for node in self.nodes.values() if (view.collidepoint(node.pos))]
+        self.overlay = pg.Surface(size, pg.SRCALPHA)
+        for node in self.visible_nodes:
+            node.draw_label(self.overlay, font, x_offset, y_offset)
+        if (pg.display.get_surface() is not None):
+            self.background = self.background.convert()
+            self.overlay = self.overlay.convert_alpha()
+        self.static_view = (size, font, x_offset, y_offset)
+
     def draw(self, window:pg.Surface, font:pg.font.Font, layer:str):
         if (self.layer != layer):
             return
 
-        x_offset = self.x_offset if self.x_temp_offset == None else self.x_temp_offset
-        y_offset = self.y_offset if self.y_temp_offset == None else self.y_temp_offset
+        x_offset, y_offset = self.get_offset()
+        if (self.static_view != (window.get_size(), font, x_offset, y_offset)):
+            self.render_static(window.get_size(), font, x_offset, y_offset)
         
-        for edge in self.edges.values():
-            edge.draw(window, x_offset, y_offset)
+        window.blit(self.background, (0, 0))
+        for node in self.visible_nodes:
+            node.draw(window, x_offset, y_offset)
+        window.blit(self.overlay, (0, 0))
 
-        for node in self.nodes.values():
-            node.draw(window, font, x_offset, y_offset)
+    def __getstate__(self) -> dict:
+        """Rendered layers are pygame surfaces, which snapshots cannot hold"""
+        state = self.__dict__.copy()
+        for name in ('static_view', 'background', 'overlay', 'visible_nodes'):
+            state.pop(name, None)
+        return state
 
 
 class RegionGraph(Graph):
     regions:dict[int, 'Region']
+    open_firms:FirmPool
+    distances = None
 
     def __init__(self, layer:str):
         super().__init__(layer)
         self.regions = {}
+        self.open_firms = FirmPool()
     
     def add_region(self, node_ids:list[int], no_households:int, no_firms:int):
         region_nodes = []
@@ -96,6 +135,7 @@ class RegionGraph(Graph):
             region_nodes.append(self.nodes.get(id))
 
         region = Region(region_nodes)
+        region.city_open_firms = self.open_firms
         for _ in range(no_households):
             region.add_household(config.get('CONTACT_RATES', {}).get('HOUSEHOLD', 4))
         
@@ -104,14 +144,56 @@ class RegionGraph(Graph):
 
         self.regions[region.id] = region
     
+    def index_regions(self):
+        """Precomputes region adjacency. A neighbour is weighted by the number of the region's nodes it shares,
+        which is how many times get_close_firms lists its firms."""
+        node_regions:dict[Node, list[Region]] = {}
+        for region in self.regions.values():
+            for node in dict.fromkeys(region.nodes):
+                node_regions.setdefault(node, []).append(region)
+
+        for region in self.regions.values():
+            shared:dict[Region, int] = {}
+            for node in region.nodes:
+                for _region in node_regions[node]:
+                    if (_region != region):
+                        shared[_region] = shared.get(_region, 0) + 1
+            region.neighbours = list(shared.items())
+
     def get_close_firms(self, region:Region) -> list[Firm]:
         close_firms  = list(region.firms)
-        for _region in self.regions.values():
-            for node in region.nodes:
-                if (node in _region.nodes and _region != region):
-                    close_firms.extend(_region.firms)
+        for _region, shared_nodes in region.neighbours:
+            for _ in range(shared_nodes):
+                close_firms.extend(_region.firms)
         return close_firms
 
+    def choose_close_firm(self, region:Region, excluded:Firm=None) -> Firm | None:
+        """Uniform draw over the open firms of get_close_firms(region) with one copy of excluded removed,
+        sampled from the open-firm pools without building the list"""
+        candidates = [(region, 1)] + region.neighbours
+        weights = [len(_region.open_firms) * shared_nodes for _region, shared_nodes in candidates]
+        excluded_weight = 0
+        if (excluded is not None and excluded in excluded.region.open_firms):
+            excluded_weight = 1 if any(_region is excluded.region for _region, _ in candidates) else 0
+        if (sum(weights) - excluded_weight <= 0):
+            return None
+
+        while True:
+            _region, shared_nodes = random.choices(candidates, weights)[0]
+            firm = _region.open_firms.choice()
+            if (firm is excluded and random.random() < 1 / shared_nodes):
+                continue
+            return firm
+
+    def choose_firm(self, excluded:Firm=None) -> Firm | None:
+        """Uniform draw over every open firm other than excluded"""
+        if (len(self.open_firms) - (excluded in self.open_firms) <= 0):
+            return None
+        while True:
+            firm = self.open_firms.choice()
+            if (firm is not excluded):
+                return firm
+
     def get_firms(self) -> list[Firm]:
         firms = []
         for region in self.regions.values():
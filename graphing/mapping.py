@@ -2,8 +2,12 @@ import configuration as config
 from functools import lru_cache
 from graphing.core import Node, Edge
 from graphing.graph import Graph, RegionGraph
+from graphing.distance import load_distance_table
 from transport.transportation import Route, TrainRoute, JeepRoute, BusRoute
 import pandas as pd
+import numpy as np
+import itertools
+import hashlib
 import heapq
 import logging
 import math
@@ -13,18 +17,7 @@ import os
 LOGGER = logging.getLogger('Mapping')
 
 
-class State:
-    def __init__(self, node:Node, cost:float, route:Route | None, previous_state):
-        self.node = node
-        self.cost = cost
-        self.route = route
-        self.previous_state = previous_state
-
-    def __lt__(self, other:'State'):
-        return self.cost < other.cost
-
-
-@lru_cache(maxsize=None, typed=False)
+@lru_cache(maxsize=1024, typed=False)
 def shortest_edge_path(start_id: tuple[str, int], end_id: tuple[str, int], city:RegionGraph, railway:Graph) -> list[Edge]:
     total_nodes = city.nodes.copy()
     total_nodes.update(railway.nodes)
@@ -77,187 +70,315 @@ def shortest_edge_path(start_id: tuple[str, int], end_id: tuple[str, int], city:
     return path
 
 
-def shortest_path(start_node:Node, end_node:Node, routes:list[Route]) -> list[tuple[Node, Route | None]]:
-    if (start_node == end_node):
-        return []
+def _reconstruct_path(state:tuple) -> list[tuple[Node, Route | None]]:
+    path = []
+    while state is not None:
+        _, _, node, route, state = state
+        path.append((node, route))
+    return path[::-1]
+
 
-    open_set = []
-    heapq.heappush(open_set, State(start_node, 0, None, None))
+def _search(start_node:Node, targets:set[tuple[str, int]], routes:list[Route]):
+    """Label-setting transit search from start_node. Yields the first state popped at each target node,
+    in order of cost, and keeps expanding until every target was reached or the network is exhausted.
+    States are (cost, counter, node, route, previous state) tuples; the counter breaks cost ties in push order."""
+    available_routes = set(routes)
+    counter = itertools.count()
+    open_set = [(0, next(counter), start_node, None, None)]
 
     TRANSFER_PENALTY = 5.0
 
     visited = {}
+    remaining = set(targets)
 
     while open_set:
-        current_state:State = heapq.heappop(open_set)
-        current_node:Node = current_state.node
-        current_route:Route | None = current_state.route
+        current_state = heapq.heappop(open_set)
+        cost, _, current_node, current_route, _ = current_state
         
-        if current_node == end_node:
-            # Reconstruct and return the raw path
-            path = []
-            curr = current_state
-            while curr is not None:
-                path.append((curr.node, curr.route))
-                curr = curr.previous_state
-            return path[::-1]
+        if current_node.id in remaining:
+            remaining.discard(current_node.id)
+            yield current_state
+            if (not remaining):
+                return
             
-        state_key = (current_node.id, current_route.id if current_route else None)
-        if state_key in visited and visited[state_key] <= current_state.cost:
+        state_key = (current_node, current_route)
+        if state_key in visited and visited[state_key] <= cost:
             continue
-        visited[state_key] = current_state.cost
+        visited[state_key] = cost
 
         # Scenario A: Walking
         if current_route is None:
             # 1. Walk to neighbors
             for edge in current_node.edges:
                 neighbor_node = edge.get_adjacent_node(current_node)
-                walk_cost = edge.distance / 75
-                heapq.heappush(open_set, State(neighbor_node, current_state.cost + walk_cost, None, current_state))
+                heapq.heappush(open_set, (cost + edge.distance / 75, next(counter), neighbor_node, None, current_state))
                 
             # 2. Board available routes at this node
-            for route in routes:
-                if current_node in route.ordered_nodes:
-                    heapq.heappush(open_set, State(current_node, current_state.cost + TRANSFER_PENALTY, route, current_state))
+            for route in current_node.routes:
+                if route in available_routes:
+                    heapq.heappush(open_set, (cost + TRANSFER_PENALTY, next(counter), current_node, route, current_state))
 
         # Scenario B: Riding
         else:
             # 1. Stay on vehicle
-            for idx, node in enumerate(current_route.ordered_nodes):
-                if (current_node == node and idx + 1 < len(current_route.ordered_nodes)):
-                    neighbor_node = current_route.ordered_nodes[idx + 1]
-                    edge_to_take = current_route.path[idx]
-
-                    ride_cost = edge_to_take.distance / current_route.expected_speed
-                    heapq.heappush(open_set, State(neighbor_node, current_state.cost + ride_cost, current_route, current_state))
+            for idx in current_route.stop_positions[current_node]:
+                if (idx + 1 < len(current_route.ordered_nodes)):
+                    ride_cost = current_route.path[idx].distance / current_route.expected_speed
+                    heapq.heappush(open_set, (cost + ride_cost, next(counter), current_route.ordered_nodes[idx + 1], current_route, current_state))
                 
             # 2. Alight (Switch to walking)
-            heapq.heappush(open_set, State(current_node, current_state.cost, None, current_state))
+            heapq.heappush(open_set, (cost, next(counter), current_node, None, current_state))
+
 
+def shortest_path(start_node:Node, end_node:Node, routes:list[Route]) -> list[tuple[Node, Route | None]]:
+    if (start_node == end_node):
+        return []
+
+    for state in _search(start_node, {end_node.id}, routes):
+        return _reconstruct_path(state)
     return []
 
 
-def load_graph() -> tuple[RegionGraph, Graph, list[Route]]:
-    if (not config.__config):
-        config.init()
+def shortest_paths_from(start_node:Node, end_nodes:list[Node], routes:list[Route]) -> dict[tuple[str, int], list[tuple[Node, Route | None]]]:
+    """One-to-many variant of shortest_path. Expands the search from start_node once and returns the raw path
+    to every reachable end node, identical to what shortest_path would return for each pair."""
+    targets = {node.id for node in end_nodes if node != start_node}
+    return {state[2].id:_reconstruct_path(state) for state in _search(start_node, targets, routes)}
+
+
+MAP_PATH = './map/'
+COMPILED_MAP_NAME = 'compiled.npz'
+SYNTHETIC_SPEC_NAME = 'synthetic.json'
+MAP_SOURCES = (
+    'city/nodes.xlsx', 'city/edges.xlsx', 'city/regions.xlsx', 'city/routes.xlsx',
+    'railway/nodes.xlsx', 'railway/edges.xlsx', 'railway/routes.xlsx', 'transfer.xlsx'
+)
+RESIDENTIAL_UNIT_RATIO = 0.0435
+BUSINESS_UNIT_RATIO = 0.055
 
-    map_path = './map/'
+
+def map_hash(map_path:str=MAP_PATH) -> str:
+    """Content hash of the source spreadsheets, used to version every artifact derived from the map.
+    A generated map is versioned by its synthetic.json parameters instead."""
+    digest = hashlib.sha256()
+    sources = (SYNTHETIC_SPEC_NAME,) if os.path.exists(os.path.join(map_path, SYNTHETIC_SPEC_NAME)) else MAP_SOURCES
+    for source in sources:
+        digest.update(source.encode())
+        with open(os.path.join(map_path, source), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _flatten(groups:list[list[int]]) -> tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(groups) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(group) for group in groups])
+    values = np.array([value for group in groups for value in group], dtype=np.int64)
+    return (offsets, values)
+
+
+def _unflatten(offsets:np.ndarray, values:np.ndarray) -> list[list[int]]:
+    values = values.tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def compile_map(map_path:str=MAP_PATH) -> dict[str, np.ndarray]:
+    """Parses the map spreadsheets into flat integer arrays. Only rows that load successfully are kept,
+    in the order they were added, so rebuilding from the arrays reproduces the same node and edge ids."""
+    compiled = {'source_hash':np.array(map_hash(map_path))}
     city_graph = RegionGraph('city')
     railway_graph = Graph('railway')
     graphs: list[Graph] = [city_graph, railway_graph]
-    
-    # Load nodes and edges for each graph
-    LOGGER.info('Generating nodes and edges for graphs...')
+
+    LOGGER.info('Compiling nodes and edges for graphs...')
     for graph in graphs:
+        node_rows = []
         nodes = pd.read_excel(f"{map_path}/{graph.layer}/nodes.xlsx", index_col=0)
         for i, node_xl in nodes.iterrows():
             if (pd.isna(i)):
                 LOGGER.debug(f"Skipping node with NaN index in {graph.layer} graph.")
                 continue
-            graph.add_node(int(node_xl['X-Coordinate']), int(node_xl['Y-Coordinate']), int(i))
-        
+            node_rows.append((int(i), int(node_xl['X-Coordinate']), int(node_xl['Y-Coordinate'])))
+            graph.add_node(node_rows[-1][1], node_rows[-1][2], node_rows[-1][0])
+        compiled[f'{graph.layer}_nodes'] = np.array(node_rows, dtype=np.int64).reshape(-1, 3)
+
+        edge_rows = []
         edges = pd.read_excel(f"{map_path}/{graph.layer}/edges.xlsx", index_col=0)
         for i in range(len(edges)):
             edge_xl = edges.iloc[i]
             try:
-                graph.add_edge(int(edge_xl['Distance (m)']), (graph.layer, int(edge_xl['Node 1'])), (graph.layer, int(edge_xl['Node 2'])))
+                edge_row = (int(edge_xl['Node 1']), int(edge_xl['Node 2']), int(edge_xl['Distance (m)']))
+                graph.add_edge(edge_row[2], (graph.layer, edge_row[0]), (graph.layer, edge_row[1]))
+                edge_rows.append(edge_row)
             except Exception as e:
                 LOGGER.debug(f"Error adding edge {i}: {e}")
-                LOGGER.debug(f"Node 1: {(graph.layer, int(edge_xl['Node 1']))}, Node 2: {(graph.layer, int(edge_xl['Node 2']))}")
-    
-    # Load regions for the city graph
-    LOGGER.info('Generating regions for city map...')
+        compiled[f'{graph.layer}_edges'] = np.array(edge_rows, dtype=np.int64).reshape(-1, 3)
+
+    LOGGER.info('Compiling regions for city map...')
+    region_nodes = []
+    region_units = []
     regions = pd.read_excel(f'{map_path}/{city_graph.layer}/regions.xlsx', index_col=0)
     regions[['Map edge nodes within the region', 'Street Nodes within the Region']] = regions[['Map edge nodes within the region', 'Street Nodes within the Region']].astype(str)
-
     for i in range(len(regions)):
         region_xl = regions.iloc[i]
         nodes = region_xl['Map edge nodes within the region'] if region_xl['Map edge nodes within the region'] != 'nan' else ""
         nodes +=  region_xl['Street Nodes within the Region'] if region_xl['Street Nodes within the Region'] != 'nan' else ""
 
         nodes = nodes.strip(",")
-        node_ids = [(city_graph.layer, int(node_id)) for node_id in nodes.split(",")]
+        node_ids = [int(node_id) for node_id in nodes.split(",")]
         try:
-            city_graph.add_region(node_ids, math.ceil(int(region_xl['Alloted Residential Units']) * 0.0435), math.ceil(int(region_xl['Alloted Business Units']) * 0.055))
+            region_units.append((int(region_xl['Alloted Residential Units']), int(region_xl['Alloted Business Units'])))
+            region_nodes.append(node_ids)
         except Exception as e:
-            LOGGER.debug(f"Error adding region {i}: {e}")
-            LOGGER.debug(f"Node IDs: {node_ids}")
-    
-    LOGGER.info('Generating transfer edges between city graph and railway graph...')
-    # Load transfer edges between city and railway graph
+            LOGGER.debug(f"Error compiling region {i}: {e}")
+    compiled['region_node_offsets'], compiled['region_node_ids'] = _flatten(region_nodes)
+    compiled['region_units'] = np.array(region_units, dtype=np.int64).reshape(-1, 2)
+
+    LOGGER.info('Compiling transfer edges between city graph and railway graph...')
+    transfer_rows = []
     transfer_edges = pd.read_excel(f"{map_path}/transfer.xlsx", index_col=0)
     for i in range(len(transfer_edges)):
         edge_xl = transfer_edges.iloc[i]
         try:
             city_node_id = (city_graph.layer, int(edge_xl['Node 1 (Layer 1)']))
             railway_node_id = (railway_graph.layer, int(edge_xl['Node 2 (Layer 2)']))
-            city_node = city_graph.get_node(city_node_id)
-            railway_node = railway_graph.get_node(railway_node_id)
-            if not city_node or not railway_node:
+            if not city_graph.get_node(city_node_id) or not railway_graph.get_node(railway_node_id):
                 raise ValueError(f"Invalid node IDs for transfer edge: {city_node_id}, {railway_node_id}")
-            transfer_edge = Edge(city_node, railway_node, 50, ('transfer', i))
-            city_graph.edges[transfer_edge.id] = transfer_edge
-            railway_graph.edges[transfer_edge.id] = transfer_edge
-            city_node.edges.append(transfer_edge)
-            railway_node.edges.append(transfer_edge)
+            transfer_rows.append((i, city_node_id[1], railway_node_id[1]))
         except Exception as e:
             LOGGER.debug(f"Error adding transfer edge {i}: {e}")
-            LOGGER.debug(f"City Node ID: {(city_graph.layer, int(edge_xl['City Node']))}, Railway Node ID: {(railway_graph.layer, int(edge_xl['Railway Node']))}")
-    
-    # Load routes for transportation
-    LOGGER.info('Generating routes for city graph...')
-    routes = []
+    compiled['transfers'] = np.array(transfer_rows, dtype=np.int64).reshape(-1, 3)
 
+    LOGGER.info('Compiling routes for city graph...')
+    route_rows = []
+    route_edges = []
     route_data = pd.read_excel(f"{map_path}/{city_graph.layer}/routes.xlsx", index_col=None)
     for i in range(len(route_data)):
         route_xl = route_data.iloc[i]
         node_id = (city_graph.layer, int(route_xl['Node 1']))
-        reverse_node_id = (city_graph.layer, int(route_xl['Node 2']))
-        node = city_graph.get_node(node_id)
-        reverse_node = city_graph.get_node(reverse_node_id)
-        if not node:
+        if not city_graph.get_node(node_id):
             LOGGER.debug(f"Error loading route {i}: Node {node_id} not found in city graph.")
             continue
         try:
-            edges = shortest_edge_path((city_graph.layer, int(route_xl['Node 1'])), (city_graph.layer, int(route_xl['Node 2'])), city_graph, railway_graph)
-            reversed_edges = edges.copy()
-            reversed_edges.reverse()
+            edges = shortest_edge_path(node_id, (city_graph.layer, int(route_xl['Node 2'])), city_graph, railway_graph)
         except Exception as e:
             LOGGER.debug(f"Error finding path for route {i}: {e}")
-            LOGGER.debug(f"Node 1: {(city_graph.layer, int(route_xl['Node 1']))}, Node 2: {(city_graph.layer, int(route_xl['Node 2']))}")
-            continue # Interval
-        jeep_route = JeepRoute(node, edges, city_graph, int(route_xl['Interval']), int(route_xl['Peak Interval']))
-        jeep_return_route = JeepRoute(reverse_node, reversed_edges, city_graph, int(route_xl['Interval']), int(route_xl['Peak Interval']))
-        bus_route = BusRoute(node, edges, city_graph, int(route_xl['Interval'])*1.5, int(route_xl['Peak Interval'])*1.5)
-        bus_return_route = BusRoute(reverse_node, reversed_edges, city_graph, int(route_xl['Interval'])*1.5, int(route_xl['Peak Interval'])*1.5)
-        routes.append(jeep_route)
-        routes.append(jeep_return_route)
-        routes.append(bus_route)
-        routes.append(bus_return_route)
+            continue
+        route_rows.append((int(route_xl['Node 1']), int(route_xl['Node 2']), int(route_xl['Interval']), int(route_xl['Peak Interval'])))
+        route_edges.append([edge.id[1] for edge in edges])
+    compiled['city_routes'] = np.array(route_rows, dtype=np.int64).reshape(-1, 4)
+    compiled['city_route_edge_offsets'], compiled['city_route_edge_ids'] = _flatten(route_edges)
 
+    route_rows = []
+    route_edges = []
     route_data = pd.read_excel(f"{map_path}/{railway_graph.layer}/routes.xlsx", index_col=None)
     for i in range(len(route_data)):
         route_xl = route_data.iloc[i]
         node_id = (railway_graph.layer, int(route_xl['Node 1']))
-        reverse_node_id = (railway_graph.layer, int(route_xl['Node 2']))
-        node = railway_graph.get_node(node_id)
-        reverse_node = railway_graph.get_node(reverse_node_id)
-        if not node:
+        if not railway_graph.get_node(node_id):
             LOGGER.debug(f"Error loading route {i}: Node {node_id} not found in railway graph.")
             continue
-        edge_ids = route_xl['Path'].split(',')
-        edge_ids = [(railway_graph.layer, int(edge_id.strip())) for edge_id in edge_ids]
-        path = [railway_graph.get_edge(edge_id) for edge_id in edge_ids]
+        route_rows.append((int(route_xl['Node 1']), int(route_xl['Node 2']), int(route_xl['Interval']), int(route_xl['Peak Interval'])))
+        route_edges.append([int(edge_id.strip()) for edge_id in route_xl['Path'].split(',')])
+    compiled['railway_routes'] = np.array(route_rows, dtype=np.int64).reshape(-1, 4)
+    compiled['railway_route_edge_offsets'], compiled['railway_route_edge_ids'] = _flatten(route_edges)
+
+    return compiled
+
+
+def build_environment(compiled:dict[str, np.ndarray]) -> tuple[RegionGraph, Graph, list[Route]]:
+    city_graph = RegionGraph('city')
+    railway_graph = Graph('railway')
+    graphs: list[Graph] = [city_graph, railway_graph]
+
+    LOGGER.info('Generating nodes and edges for graphs...')
+    for graph in graphs:
+        for node_id, x, y in compiled[f'{graph.layer}_nodes'].tolist():
+            graph.add_node(x, y, node_id)
+        for node_1, node_2, distance in compiled[f'{graph.layer}_edges'].tolist():
+            graph.add_edge(distance, (graph.layer, node_1), (graph.layer, node_2))
+
+    LOGGER.info('Generating regions for city map...')
+    region_nodes = _unflatten(compiled['region_node_offsets'], compiled['region_node_ids'])
+    for i, (node_ids, (residential_units, business_units)) in enumerate(zip(region_nodes, compiled['region_units'].tolist())):
+        node_ids = [(city_graph.layer, node_id) for node_id in node_ids]
+        try:
+            city_graph.add_region(node_ids, math.ceil(residential_units * RESIDENTIAL_UNIT_RATIO), math.ceil(business_units * BUSINESS_UNIT_RATIO))
+        except Exception as e:
+            LOGGER.debug(f"Error adding region {i}: {e}")
+            LOGGER.debug(f"Node IDs: {node_ids}")
+    city_graph.index_regions()
+
+    LOGGER.info('Generating transfer edges between city graph and railway graph...')
+    for i, city_node_id, railway_node_id in compiled['transfers'].tolist():
+        city_node = city_graph.get_node((city_graph.layer, city_node_id))
+        railway_node = railway_graph.get_node((railway_graph.layer, railway_node_id))
+        transfer_edge = Edge(city_node, railway_node, 50, ('transfer', i))
+        city_graph.edges[transfer_edge.id] = transfer_edge
+        railway_graph.edges[transfer_edge.id] = transfer_edge
+        city_node.edges.append(transfer_edge)
+        railway_node.edges.append(transfer_edge)
+
+    LOGGER.info('Generating routes for city graph...')
+    routes = []
+    route_edges = _unflatten(compiled['city_route_edge_offsets'], compiled['city_route_edge_ids'])
+    for (node_1, node_2, interval, peak_interval), edge_ids in zip(compiled['city_routes'].tolist(), route_edges):
+        node = city_graph.get_node((city_graph.layer, node_1))
+        reverse_node = city_graph.get_node((city_graph.layer, node_2))
+        edges = [city_graph.get_edge((city_graph.layer, edge_id)) for edge_id in edge_ids]
+        reversed_edges = edges.copy()
+        reversed_edges.reverse()
+        routes.append(JeepRoute(node, edges, city_graph, interval, peak_interval))
+        routes.append(JeepRoute(reverse_node, reversed_edges, city_graph, interval, peak_interval))
+        routes.append(BusRoute(node, edges, city_graph, interval*1.5, peak_interval*1.5))
+        routes.append(BusRoute(reverse_node, reversed_edges, city_graph, interval*1.5, peak_interval*1.5))
+
+    route_edges = _unflatten(compiled['railway_route_edge_offsets'], compiled['railway_route_edge_ids'])
+    for (node_1, node_2, interval, peak_interval), edge_ids in zip(compiled['railway_routes'].tolist(), route_edges):
+        node = railway_graph.get_node((railway_graph.layer, node_1))
+        reverse_node = railway_graph.get_node((railway_graph.layer, node_2))
+        path = [railway_graph.get_edge((railway_graph.layer, edge_id)) for edge_id in edge_ids]
         reverse_path = path.copy()
         reverse_path.reverse()
-        route = TrainRoute(node, path, railway_graph, int(route_xl['Interval']), int(route_xl['Peak Interval']))
-        return_route = TrainRoute(reverse_node, reverse_path, railway_graph, int(route_xl['Interval']), int(route_xl['Peak Interval']))
-        routes.append(route)
-        routes.append(return_route)
-    
+        routes.append(TrainRoute(node, path, railway_graph, interval, peak_interval))
+        routes.append(TrainRoute(reverse_node, reverse_path, railway_graph, interval, peak_interval))
+
     LOGGER.info('Graph ready!')
     return (city_graph, railway_graph, routes)
 
 
+def load_compiled_map(map_path:str=MAP_PATH) -> dict[str, np.ndarray]:
+    """Loads the compiled map artifact, recompiling it whenever a source spreadsheet changed"""
+    compiled_path = os.path.join(map_path, COMPILED_MAP_NAME)
+    source_hash = map_hash(map_path)
+    if (os.path.exists(compiled_path)):
+        with np.load(compiled_path) as artifact:
+            if (str(artifact['source_hash']) == source_hash):
+                return dict(artifact)
+        LOGGER.info(f'Map spreadsheets changed since {compiled_path} was built.')
+
+    if (os.path.exists(os.path.join(map_path, SYNTHETIC_SPEC_NAME))):
+        from graphing.synthetic import generate_city, load_spec
+        compiled = generate_city(**load_spec(map_path))
+        """synthetic.json may list only some parameters, so the artifact is stamped with the hash of the file
+        itself rather than of the spec completed with defaults"""
+        compiled['source_hash'] = np.array(source_hash)
+    else:
+        compiled = compile_map(map_path)
+    np.savez(compiled_path, **compiled)
+    LOGGER.info(f'Compiled map written to {compiled_path}.')
+    return compiled
+
+
+def load_graph() -> tuple[RegionGraph, Graph, list[Route]]:
+    if (not config.__config):
+        config.init()
+
+    map_path = config.get('MAP_PATH', MAP_PATH)
+    compiled = load_compiled_map(map_path)
+    city_graph, railway_graph, routes = build_environment(compiled)
+    city_graph.distances = load_distance_table(city_graph)
+    return (city_graph, railway_graph, routes)
+
+
 if __name__ == '__main__':
     load_graph()
\ No newline at end of file
@@ -0,0 +1,227 @@
+import configuration as config
+from graphing.mapping import _flatten, build_environment, load_graph, COMPILED_MAP_NAME, SYNTHETIC_SPEC_NAME, MAP_SOURCES, MAP_PATH, RESIDENTIAL_UNIT_RATIO, BUSINESS_UNIT_RATIO
+from graphing.graph import RegionGraph, Graph
+from transport.transportation import Route
+import numpy as np
+import hashlib
+import logging
+import heapq
+import math
+import json
+import os
+
+LOGGER = logging.getLogger('Synthetic')
+
+"""Parameters of a generated city and their defaults, which roughly match the size of the bundled map.
+Densities are households and firms per region node. Every city line runs a jeep and a bus in both directions,
+the same as a row of city/routes.xlsx."""
+DEFAULT_SPEC = {
+    'nodes':600,
+    'topology':'grid',
+    'regions':150,
+    'household_density':12.0,
+    'firm_density':1.5,
+    'city_lines':28,
+    'rail_lines':2,
+    'station_spacing':4,
+    'spacing':25,
+    'meters_per_pixel':10,
+    'interval':15,
+    'peak_interval':8,
+    'rail_interval':10,
+    'rail_peak_interval':6,
+    'seed':0,
+    }
+
+
+def spec_bytes(spec:dict) -> bytes:
+    return json.dumps(spec, sort_keys=True, indent=2).encode()
+
+
+def spec_hash(spec:dict) -> str:
+    """Same digest map_hash computes over a written synthetic.json"""
+    digest = hashlib.sha256()
+    digest.update(SYNTHETIC_SPEC_NAME.encode())
+    digest.update(spec_bytes(spec))
+    return digest.hexdigest()
+
+
+def _street_grid(side:int, spec:dict, rng:np.random.Generator) -> tuple[np.ndarray, list[tuple[int, int]]]:
+    """Node coordinates and node index pairs of the street network. Organic cities jitter the nodes, add some
+    diagonals and drop streets at random while keeping a random spanning tree so every node stays reachable."""
+    ix, iy = np.meshgrid(np.arange(side), np.arange(side), indexing='ij')
+    coordinates = np.stack([ix.ravel(), iy.ravel()], axis=1).astype(float) * spec['spacing']
+    index = lambda x, y: x * side + y
+    streets = [(index(x, y), index(x + 1, y)) for x in range(side - 1) for y in range(side)]
+    streets += [(index(x, y), index(x, y + 1)) for x in range(side) for y in range(side - 1)]
+    if (spec['topology'] == 'grid'):
+        return (coordinates, streets)
+    elif (spec['topology'] != 'organic'):
+        raise ValueError(f"Unknown topology '{spec['topology']}', expected 'grid' or 'organic'")
+
+    coordinates += rng.uniform(-0.35, 0.35, coordinates.shape) * spec['spacing']
+    for x in range(side - 1):
+        for y in range(side - 1):
+            if (rng.random() < 0.3):
+                streets.append((index(x, y), index(x + 1, y + 1)) if rng.random() < 0.5 else (index(x + 1, y), index(x, y + 1)))
+
+    parents = list(range(side * side))
+    def find(node:int) -> int:
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    kept = []
+    for i in rng.permutation(len(streets)).tolist():
+        a, b = find(streets[i][0]), find(streets[i][1])
+        if (a != b):
+            parents[a] = b
+            kept.append(streets[i])
+        elif (rng.random() < 0.6):
+            kept.append(streets[i])
+    return (coordinates, kept)
+
+
+def _shortest_edges(adjacency:list[list[tuple[int, int, int]]], start:int, end:int) -> list[tuple[int, int]]:
+    """(node, edge position) steps of the shortest street path from start to end"""
+    distances = {start:0}
+    previous = {}
+    queue = [(0, start)]
+    while queue:
+        distance, node = heapq.heappop(queue)
+        if (node == end):
+            break
+        if (distance > distances[node]):
+            continue
+        for neighbour, length, edge in adjacency[node]:
+            if (distance + length < distances.get(neighbour, math.inf)):
+                distances[neighbour] = distance + length
+                previous[neighbour] = (node, edge)
+                heapq.heappush(queue, (distance + length, neighbour))
+
+    steps = []
+    node = end
+    while node != start:
+        node, edge = previous[node]
+        steps.append((node, edge))
+    steps.reverse()
+    return steps
+
+
+def _far_pair(side:int, rng:np.random.Generator) -> tuple[int, int]:
+    """Two node indices at least half the city apart"""
+    while True:
+        a, b = rng.integers(0, side * side, 2).tolist()
+        if (abs(a // side - b // side) + abs(a % side - b % side) >= side // 2):
+            return (a, b)
+
+
+def generate_city(**parameters) -> dict[str, np.ndarray]:
+    """Generates a city in the compiled map format, ready for build_environment"""
+    spec = {**DEFAULT_SPEC, **parameters}
+    unknown = set(spec) - set(DEFAULT_SPEC)
+    if (unknown):
+        raise ValueError(f"Unknown synthetic map parameters: {', '.join(sorted(unknown))}")
+    rng = np.random.default_rng(spec['seed'])
+    side = max(3, round(math.sqrt(spec['nodes'])))
+    compiled = {'source_hash':np.array(spec_hash(spec))}
+
+    LOGGER.info(f"Generating a {spec['topology']} city of {side * side} nodes...")
+    coordinates, streets = _street_grid(side, spec, rng)
+    lengths = [max(1, round(math.dist(coordinates[a], coordinates[b]) * spec['meters_per_pixel'])) for a, b in streets]
+    compiled['city_nodes'] = np.array([(i + 1, round(x), round(y)) for i, (x, y) in enumerate(coordinates.tolist())], dtype=np.int64).reshape(-1, 3)
+    compiled['city_edges'] = np.array([(a + 1, b + 1, length) for (a, b), length in zip(streets, lengths)], dtype=np.int64).reshape(-1, 3)
+    adjacency = [[] for _ in range(side * side)]
+    for position, ((a, b), length) in enumerate(zip(streets, lengths)):
+        adjacency[a].append((b, length, position))
+        adjacency[b].append((a, length, position))
+
+    """Regions are square blocks of street cells. Neighbouring blocks share their boundary nodes, which is
+    what makes them adjacent for shopping trips."""
+    tile = max(1, round((side - 1) / math.sqrt(spec['regions'])))
+    region_nodes = []
+    region_units = []
+    for x0 in range(0, side - 1, tile):
+        for y0 in range(0, side - 1, tile):
+            nodes = [x * side + y + 1 for x in range(x0, min(x0 + tile, side - 1) + 1) for y in range(y0, min(y0 + tile, side - 1) + 1)]
+            households = rng.poisson(spec['household_density'] * len(nodes))
+            firms = max(1, rng.poisson(spec['firm_density'] * len(nodes)))
+            region_nodes.append(nodes)
+            region_units.append((math.floor(households / RESIDENTIAL_UNIT_RATIO), math.floor(firms / BUSINESS_UNIT_RATIO)))
+    compiled['region_node_offsets'], compiled['region_node_ids'] = _flatten(region_nodes)
+    compiled['region_units'] = np.array(region_units, dtype=np.int64).reshape(-1, 2)
+
+    route_rows = []
+    route_edges = []
+    for _ in range(spec['city_lines']):
+        start, end = _far_pair(side, rng)
+        route_rows.append((start + 1, end + 1, spec['interval'], spec['peak_interval']))
+        route_edges.append([edge + 1 for _, edge in _shortest_edges(adjacency, start, end)])
+    compiled['city_routes'] = np.array(route_rows, dtype=np.int64).reshape(-1, 4)
+    compiled['city_route_edge_offsets'], compiled['city_route_edge_ids'] = _flatten(route_edges)
+
+    """Rail lines follow a street path with a station every station_spacing nodes, each station linked to the
+    street node below it by a transfer edge"""
+    railway_nodes = []
+    railway_edges = []
+    transfers = []
+    route_rows = []
+    route_edges = []
+    for _ in range(spec['rail_lines']):
+        start, end = _far_pair(side, rng)
+        steps = _shortest_edges(adjacency, start, end)
+        path = [node for node, _ in steps] + [end]
+        stations = path[::spec['station_spacing']] if (len(path) - 1) % spec['station_spacing'] == 0 else path[::spec['station_spacing']] + [end]
+        line_edges = []
+        for i, city_node in enumerate(stations):
+            railway_nodes.append((len(railway_nodes) + 1, round(coordinates[city_node][0]), round(coordinates[city_node][1])))
+            transfers.append((len(transfers), city_node + 1, railway_nodes[-1][0]))
+            if (i > 0):
+                length = round(math.dist(coordinates[stations[i - 1]], coordinates[city_node]) * spec['meters_per_pixel'])
+                railway_edges.append((railway_nodes[-2][0], railway_nodes[-1][0], max(1, length)))
+                line_edges.append(len(railway_edges))
+        route_rows.append((railway_nodes[-len(stations)][0], railway_nodes[-1][0], spec['rail_interval'], spec['rail_peak_interval']))
+        route_edges.append(line_edges)
+    compiled['railway_nodes'] = np.array(railway_nodes, dtype=np.int64).reshape(-1, 3)
+    compiled['railway_edges'] = np.array(railway_edges, dtype=np.int64).reshape(-1, 3)
+    compiled['transfers'] = np.array(transfers, dtype=np.int64).reshape(-1, 3)
+    compiled['railway_routes'] = np.array(route_rows, dtype=np.int64).reshape(-1, 4)
+    compiled['railway_route_edge_offsets'], compiled['railway_route_edge_ids'] = _flatten(route_edges)
+    return compiled
+
+
+def generate_environment(**parameters) -> tuple[RegionGraph, Graph, list[Route]]:
+    """Builds a generated city in memory, without its distance table"""
+    if (not config.__config):
+        config.init()
+    return build_environment(generate_city(**parameters))
+
+
+def load_spec(map_path:str) -> dict:
+    with open(os.path.join(map_path, SYNTHETIC_SPEC_NAME)) as f:
+        return json.load(f)
+
+
+def write_map(map_path:str, **parameters) -> dict[str, np.ndarray]:
+    """Writes synthetic.json and the compiled map into map_path so load_graph can use it through MAP_PATH.
+    The distance table and routing cache are built there on first load like for any other map."""
+    if (any(os.path.exists(os.path.join(map_path, source)) for source in MAP_SOURCES)):
+        raise ValueError(f"{map_path} holds map spreadsheets, write synthetic maps to their own directory")
+    spec = {**DEFAULT_SPEC, **parameters}
+    compiled = generate_city(**spec)
+    os.makedirs(map_path, exist_ok=True)
+    with open(os.path.join(map_path, SYNTHETIC_SPEC_NAME), 'wb') as f:
+        f.write(spec_bytes(spec))
+    np.savez(os.path.join(map_path, COMPILED_MAP_NAME), **compiled)
+    LOGGER.info(f"Synthetic map written to {map_path}.")
+    return compiled
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    config.init()
+    map_path = config.get('MAP_PATH', MAP_PATH)
+    write_map(map_path, **config.get('SYNTHETIC_MAP', {}))
+    city, railway, routes = load_graph()
+    LOGGER.info(f"{len(city.nodes)} city nodes, {len(city.regions)} regions, {len(city.get_households())} households, {len(routes)} routes")
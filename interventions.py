@@ -66,19 +66,14 @@ class RouteReduction(Policy):
             if (route in self.removed_routes):
                 simulation.routes.remove(route)
 
-        keys_to_pop = []
-        for key, checkpoints in simulation.routing_table.items():
-            for checkpoint in checkpoints:
-                if (checkpoint.route in self.removed_routes):
-                    self.removed_routing[key] = simulation.routing_table[key]
-                    keys_to_pop.append(key)
-                    break
+        keys_to_pop = simulation.routing_table.keys_using_routes(self.removed_routes)
+        for key in keys_to_pop:
+            self.removed_routing[key] = simulation.routing_table[key]
         
         for key in keys_to_pop:
             simulation.routing_table.pop(key)
 
-        for route in self.removed_routes:
-            manager.cancel(manager.TRANSPORTATION_SPAWN, route)
+        manager.cancel_many(manager.TRANSPORTATION_SPAWN, self.removed_routes)
             
     def revert(self, simulation):
         super().revert(simulation)
@@ -101,16 +96,12 @@ class MandatoryMask(Policy):
         super().implement(simulation)
         self.original_mask_compliance = simulation.mask_compliance
         simulation.mask_compliance = self.compliance
-        agents:list[Agent] = simulation.agents
-        for agent in agents:
-            agent.masked = True
+        simulation.agent_table.view('masked')[:] = True
     
     def revert(self, simulation):
         super().revert(simulation)
         simulation.mask_compliance = self.original_mask_compliance
-        agents:list[Agent] = simulation.agents
-        for agent in agents:
-            agent.masked = False
+        simulation.agent_table.view('masked')[:] = False
     
     def __str__(self):
         return f"MandatoryMask(start_time={self.start_time}, end_time={self.end_time})"
@@ -1,4 +1,6 @@
 import configuration as config
+import heapq
+import math
 import os
 
 AGENT_GO_WORK = 0
@@ -20,12 +22,31 @@ IMPLEMENT_POLICY = 15
 REVERT_POLICY = 16
 ISOLATION_PERIOD_DONE = 17
 AGENT_IMMUNITY_LOSS = 18
+SIMULATION_ROUTINE = 19
 
-_events:dict[int, list['Event']] = {}
+# Calendar of pending events: tick -> {event type: batched event}. Every tick that owns a
+# bucket is pushed once onto the _ticks min-heap so the earliest pending tick is always _ticks[0].
+_events:dict[int, dict[int, 'Event']] = {}
+_ticks:list[int] = []
+# Reverse index: (event type, object) -> [(tick, position in that tick's batch)] for cancellation.
+_slots:dict[tuple[int, object], list[tuple[int, int]]] = {}
+
+
+class _Cancelled:
+    """Tombstone cancel leaves in an event batch. Pickled by reference so snapshots keep it the same object."""
+
+    def __reduce__(self):
+        return '_CANCELLED'
+
+
+_CANCELLED = _Cancelled()
 _time_step = 0
+# Tick currently being handled, so routines can be woken without knowing the time
+_current_time = 0
 
 class Event:
     _objects:list
+    cancelled:int = 0
 
     def __init__(self, type:int, object=None):
         self.type = type
@@ -39,46 +60,140 @@ class Event:
         self._objects.append(event._object)
     
     def get_objects(self) -> list:
-        return self._objects.copy()
+        if (not self.cancelled):
+            return self._objects.copy()
+        return [object for object in self._objects if object is not _CANCELLED]
     
     def __str__(self) -> str:
         return f"Event(type={self.type})"
 
 
+class Routine:
+    """A recurring task that reschedules itself on the calendar every interval minutes. A routine with a
+    condition goes idle once the condition is false after a run, until wake_routine puts it back."""
+    counter:int = 0
+    pending:bool = False
+
+    def __init__(self, name:str, interval:int, callback, offset:int=0, condition=None):
+        self.name = name
+        self.interval = interval
+        self.callback = callback
+        self.offset = offset
+        self.condition = condition
+        self.order = Routine.counter
+        Routine.counter += 1
+
+    def run(self, time:int):
+        self.callback(time)
+        if (self.condition is not None and not self.condition()):
+            self.pending = False
+            return
+        emit(time + self.interval, Event(SIMULATION_ROUTINE, self))
+
+    def __str__(self) -> str:
+        return f"Routine(name={self.name}, interval={self.interval}, offset={self.offset})"
+
+
 def init():
-    global _time_step
+    """Starts an empty calendar, so a process can run one simulation after another"""
+    global _time_step, _current_time
     _time_step = config.get('TIME_STEP', 2)
+    _current_time = 0
+    _events.clear()
+    _ticks.clear()
+    _slots.clear()
 
 def get(time:int) -> list[Event]:
-    for target in _events.keys():
-        if (target < time):
-            raise RuntimeError("An event passed without being called.")
-        else:
-            break
+    global _current_time
+    _current_time = time
+    if (_ticks and _ticks[0] < time):
+        raise RuntimeError("An event passed without being called.")
+    if (not _ticks or _ticks[0] != time):
+        return []
+
+    heapq.heappop(_ticks)
+    events = list(_events.pop(time).values())
+    for event in events:
+        for object in event._objects:
+            if (object is None or object is _CANCELLED):
+                continue
+            _unindex(event.type, object, time)
+    return events
 
-    return _events.pop(time, [])
+def next_time() -> int | None:
+    return _ticks[0] if _ticks else None
+
+def _index(event_type:int, object, time:int, position:int):
+    key = (event_type, object)
+    slots = _slots.get(key)
+    if (slots is None):
+        _slots[key] = [(time, position)]
+    else:
+        slots.append((time, position))
+
+def _unindex(event_type:int, object, time:int):
+    key = (event_type, object)
+    slots = _slots.get(key)
+    if (slots is None):
+        return
+    remaining = [slot for slot in slots if slot[0] != time]
+    if (remaining):
+        _slots[key] = remaining
+    else:
+        del _slots[key]
 
 def emit(target_time:int, event:Event):
+    target_time = math.ceil(target_time)
     remainder = target_time % _time_step
     if (remainder):
         target_time += _time_step - remainder
-    if (target_time in _events):
-        events_in_time = _events.get(target_time)
-        for target_event in events_in_time:
-            if (target_event.type == event.type):
-                target_event.extends(event)
-                return
-        events_in_time.append(event)
+    bucket = _events.get(target_time)
+    if (bucket is None):
+        bucket = _events[target_time] = {}
+        heapq.heappush(_ticks, target_time)
+
+    target_event = bucket.get(event.type)
+    if (target_event is None):
+        bucket[event.type] = event
+        target_event = event
     else:
-        _events[target_time] = [event]
+        target_event.extends(event)
+    if (event._object is not None):
+        _index(event.type, event._object, target_time, len(target_event._objects) - 1)
 
 def cancel(event_type:int, object=None):
-    for events in _events.values():
-        for event in events:
-            if (event.type != event_type or object not in event.get_objects()):
-                continue
+    slots = _slots.pop((event_type, object), None)
+    if (slots is None):
+        return
+
+    for time, position in slots:
+        event = _events[time][event_type]
+        event._objects[position] = _CANCELLED
+        event.cancelled += 1
+
+def cancel_many(event_type:int, objects:list):
+    for object in objects:
+        cancel(event_type, object)
+
+def schedule_routine(routine:Routine, start_time:int=0):
+    first_time = routine.offset
+    if (first_time < start_time):
+        first_time += math.ceil((start_time - first_time) / routine.interval) * routine.interval
+    routine.pending = True
+    emit(first_time, Event(SIMULATION_ROUTINE, routine))
+
+def wake_routine(routine:Routine):
+    """Puts an idle routine back on the calendar at its first slot after the tick being handled"""
+    if (not routine.pending):
+        schedule_routine(routine, _current_time + 1)
+
+def handle_routine_events(event:Event, time:int):
+    if (event.type != SIMULATION_ROUTINE):
+        return
 
-            event._objects.remove(object)
+    routines:list[Routine] = event.get_objects()
+    for routine in sorted(routines, key=lambda routine: routine.order):
+        routine.run(time)
 
 
 if __name__ == '__main__':
@@ -96,17 +211,17 @@ if __name__ == '__main__':
     agent = Agent(graph, households[0])
     print("===========================================")
     for target_time, events in _events.items():
-        print(f"{target_time}: {[str(event) for event in events]}")
+        print(f"{target_time}: {[str(event) for event in events.values()]}")
     
     emit(1, agent._traverse_event)
     emit(1, agent._go_home_event)
     print("===========================================")
     for target_time, events in _events.items():
-        print(f"{target_time}: {[str(event) for event in events]}")
+        print(f"{target_time}: {[str(event) for event in events.values()]}")
     print("===========================================")
     emit(4, agent._traverse_event)
     for target_time, events in _events.items():
-        print(f"{target_time}: {[str(event) for event in events]}")
+        print(f"{target_time}: {[str(event) for event in events.values()]}")
     print('time: 3', get(3))
     print('time: 4', get(6))
     print('time: 7', get(7))
@@ -1,4 +1,5 @@
 import configuration as config
+from functools import partial
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -51,6 +52,45 @@ class Status:
         # Render the window
         plt.show()
 
+class SamplePool:
+    """Buffer of pre-drawn values refilled in bulk and served from a cursor."""
+    def __init__(self, draw, size:int):
+        self.draw = draw
+        self.size = size
+        self.reset()
+
+    def reset(self):
+        self.values = []
+        self.cursor = 0
+
+    def refill(self):
+        self.values = self.draw(self.size).tolist()
+        self.cursor = 0
+
+    def next(self):
+        if (self.cursor >= len(self.values)):
+            self.refill()
+        value = self.values[self.cursor]
+        self.cursor += 1
+        return value
+
+    def take(self, n:int) -> np.ndarray:
+        remaining = len(self.values) - self.cursor
+        if (n <= remaining):
+            result = np.array(self.values[self.cursor:self.cursor + n])
+            self.cursor += n
+            return result
+        if (n > self.size):
+            fresh = self.draw(n - remaining)
+            head = np.array(self.values[self.cursor:], dtype=fresh.dtype)
+            self.cursor = len(self.values)
+            return np.concatenate((head, fresh))
+        head = self.values[self.cursor:]
+        self.refill()
+        self.cursor = n - remaining
+        return np.array(head + self.values[:self.cursor])
+
+
 class Disease:
     def __init__(self):
         self.incubation_period_in_hours = (config.get('INCUBATION_PERIOD_IN_HOURS_SHAPE', 165.84), config.get('INCUBATION_PERIOD_IN_HOURS_RATE', 25.2))
@@ -61,32 +101,51 @@ class Disease:
         self.chance_per_contact_on_firm_retail = (config.get('CHANCE_PER_CONTACT_ON_FIRM_RETAIL_MEAN', 0.06), config.get('CHANCE_PER_CONTACT_ON_FIRM_RETAIL_STD', 0.0179))
         self.chance_per_contact_on_transport = (config.get('CHANCE_PER_CONTACT_ON_TRANSPORT_MEAN', 0.01), config.get('CHANCE_PER_CONTACT_ON_TRANSPORT_STD', 0.0051))
         self.waning_immunity_probability = config.get('WANING_IMMUNITY_PROBABILITY', 0.30)
+
+        pool_size = config.get('SAMPLE_POOL_SIZE', 4096)
+        self.pools = {
+            'household_CPC':SamplePool(partial(self._draw_CPC, self.chance_per_contact_on_household), pool_size),
+            'firm_work_CPC':SamplePool(partial(self._draw_CPC, self.chance_per_contact_on_firm_work), pool_size),
+            'firm_retail_CPC':SamplePool(partial(self._draw_CPC, self.chance_per_contact_on_firm_retail), pool_size),
+            'transport_CPC':SamplePool(partial(self._draw_CPC, self.chance_per_contact_on_transport), pool_size),
+            'incubation_period':SamplePool(partial(self._draw_duration, self.incubation_period_in_hours), pool_size),
+            'infected_duration':SamplePool(partial(self._draw_duration, self.infected_duration_in_hours), pool_size),
+            'waning_immunity_duration':SamplePool(partial(self._draw_duration, self.waning_immunity_in_hours), pool_size),
+        }
+
+    @staticmethod
+    def _draw_CPC(distribution:tuple[float, float], n:int) -> np.ndarray:
+        return np.clip(np.random.normal(loc=distribution[0], scale=distribution[1], size=n), 0.0, 1.0)
+
+    @staticmethod
+    def _draw_duration(distribution:tuple[float, float], n:int) -> np.ndarray:
+        return (np.random.gamma(shape=distribution[0], scale=1.0/distribution[1], size=n) * 60).astype(np.int64)
+
+    def reset_pools(self):
+        """Discards pre-drawn values, so draws made after reseeding the generator (as a forked scenario does) follow the new seed"""
+        for pool in self.pools.values():
+            pool.reset()
+
+    def sample_many(self, distribution:str, n:int) -> np.ndarray:
+        return self.pools[distribution].take(n)
     
     def sample_infection_household_CPC(self) -> float:
-        result = np.random.normal(loc=self.chance_per_contact_on_household[0], scale=self.chance_per_contact_on_household[1])
-        return max(0.0, min(1.0, result))
+        return self.pools['household_CPC'].next()
 
     def sample_infection_firm_work_CPC(self) -> float:
-        result = np.random.normal(loc=self.chance_per_contact_on_firm_work[0], scale=self.chance_per_contact_on_firm_work[1])
-        return max(0.0, min(1.0, result))
+        return self.pools['firm_work_CPC'].next()
 
     def sample_infection_firm_retail_CPC(self) -> float:
-        result = np.random.normal(loc=self.chance_per_contact_on_firm_retail[0], scale=self.chance_per_contact_on_firm_retail[1])
-        return max(0.0, min(1.0, result))
+        return self.pools['firm_retail_CPC'].next()
 
     def sample_infection_transport_CPC(self) -> float:
-        result = np.random.normal(loc=self.chance_per_contact_on_transport[0], scale=self.chance_per_contact_on_transport[1])
-        return max(0.0, min(1.0, result))
+        return self.pools['transport_CPC'].next()
 
     def sample_incubation_period(self) -> int:
-        result = np.random.gamma(shape=self.incubation_period_in_hours[0], scale=1.0/self.incubation_period_in_hours[1]) * 60
-        return int(result)
+        return self.pools['incubation_period'].next()
 
     def sample_infected_duration(self) -> int:
-        result = np.random.gamma(shape=self.infected_duration_in_hours[0], scale=1.0/self.infected_duration_in_hours[1]) * 60
-        return int(result)
+        return self.pools['infected_duration'].next()
 
     def sample_waning_immunity_duration(self) -> int:
-        result = np.random.gamma(shape=self.waning_immunity_in_hours[0], scale=1.0/self.waning_immunity_in_hours[1]) * 60
-        return int(result)
-
+        return self.pools['waning_immunity_duration'].next()
@@ -0,0 +1,139 @@
+import configuration as config
+from time import perf_counter_ns
+import manager
+import logging
+import cProfile
+import pstats
+import json
+import os
+
+LOGGER = logging.getLogger('Profiling')
+
+"""Opt-in instrumentation of the simulation loop, enabled with the PROFILE config key. Stats are
+[calls, objects handled, total ns, largest batch] per manager event type and per routine. A cProfile capture
+of the day set by PROFILE_DAY is taken alongside, and everything is written as JSON to PROFILE_OUTPUT."""
+enabled:bool = False
+event_stats:dict[str, list[int]] = {}
+routine_stats:dict[str, list[int]] = {}
+day_times:list[tuple[int, float]] = []
+profile_day:int = None
+_profiler:cProfile.Profile = None
+_profiled_stats:pstats.Stats = None
+_day_start:int = None
+_current_day:int = None
+
+EVENT_NAMES = {value:name for name, value in vars(manager).items() if (name.isupper() and isinstance(value, int))}
+
+
+def init():
+    global enabled, profile_day, _profiler, _profiled_stats, _day_start, _current_day
+    enabled = bool(config.get('PROFILE', False))
+    profile_day = config.get('PROFILE_DAY')
+    event_stats.clear()
+    routine_stats.clear()
+    day_times.clear()
+    _profiler = None
+    _profiled_stats = None
+    _day_start = perf_counter_ns()
+    _current_day = None
+
+
+def _record(stats:dict[str, list[int]], name:str, objects:int, elapsed:int):
+    entry = stats.get(name)
+    if (entry is None):
+        stats[name] = [1, objects, elapsed, objects]
+        return
+    entry[0] += 1
+    entry[1] += objects
+    entry[2] += elapsed
+    if (objects > entry[3]):
+        entry[3] = objects
+
+
+def record_event(event:manager.Event, elapsed:int):
+    _record(event_stats, EVENT_NAMES.get(event.type, str(event.type)), len(event._objects) - event.cancelled, elapsed)
+
+
+class TimedRoutine:
+    """Wraps a routine callback so every run is timed under the routine's name. A class rather than a closure
+    so that scheduled routines can still be pickled into a snapshot."""
+
+    def __init__(self, name:str, callback):
+        self.name = name
+        self.callback = callback
+
+    def __call__(self, time:int):
+        start = perf_counter_ns()
+        self.callback(time)
+        _record(routine_stats, self.name, 1, perf_counter_ns() - start)
+
+
+def day_started(day:int):
+    """Called at the start of every simulated day, and when a run starts or resumes partway through one.
+    Closes the previous day's timing and starts or stops the cProfile capture around PROFILE_DAY."""
+    global _day_start, _current_day, _profiler
+    if (day == _current_day):
+        return
+    now = perf_counter_ns()
+    if (_current_day is not None):
+        day_times.append((_current_day, (now - _day_start) / 1e9))
+    _day_start = now
+    _current_day = day
+    if (_profiler is not None):
+        _stop_profiler()
+    if (enabled and profile_day is not None and day == profile_day):
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+
+
+def _stop_profiler():
+    global _profiler, _profiled_stats
+    _profiler.disable()
+    _profiled_stats = pstats.Stats(_profiler)
+    _profiler = None
+
+
+def _summarize(stats:dict[str, list[int]]) -> dict[str, dict]:
+    return {
+        name:{
+            'calls':calls, 'objects':objects, 'total_s':round(total / 1e9, 4),
+            'mean_ms':round(total / calls / 1e6, 4), 'mean_batch':round(objects / calls, 2), 'max_batch':max_batch
+            }
+        for name, (calls, objects, total, max_batch) in sorted(stats.items(), key=lambda item: item[1][2], reverse=True)
+        }
+
+
+def report(extra:dict=None) -> dict:
+    global _current_day
+    if (_profiler is not None):
+        _stop_profiler()
+    if (_current_day is not None):
+        day_times.append((_current_day, (perf_counter_ns() - _day_start) / 1e9))
+        _current_day = None
+    data = {
+        'events':_summarize(event_stats),
+        'routines':_summarize(routine_stats),
+        'days':[{'day':day, 'seconds':round(seconds, 3)} for day, seconds in day_times],
+        }
+    if (_profiled_stats is not None):
+        data['profile_day'] = profile_day
+        data['profile_top'] = [
+            {'function':f'{file}:{line}({function})', 'calls':calls, 'total_s':round(total, 4), 'cumulative_s':round(cumulative, 4)}
+            for (file, line, function), (_, calls, total, cumulative, _) in
+            sorted(_profiled_stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:config.get('PROFILE_TOP', 40)]
+            ]
+    data.update(extra or {})
+    return data
+
+
+def write_report(extra:dict=None):
+    """Writes the JSON report to PROFILE_OUTPUT and the raw cProfile stats next to it"""
+    path = config.get('PROFILE_OUTPUT', 'profile.json')
+    data = report(extra)
+    if (_profiled_stats is not None):
+        stats_path = f'{os.path.splitext(path)[0]}_day{profile_day}.prof'
+        _profiled_stats.dump_stats(stats_path)
+        data['profile_stats_file'] = stats_path
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+    LOGGER.info(f"Profiling report written to {path}")
@@ -0,0 +1,286 @@
+import configuration as config
+import threading
+import logging
+import sqlite3
+import queue
+import time
+import csv
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+LOGGER = logging.getLogger('Results')
+
+_STOP = object()
+COMPARTMENT_COLUMNS = ('S', 'E', 'I', 'R', 'D', 'Total')
+DAILY_COLUMNS = ('collection', 'simulation', 'day') + COMPARTMENT_COLUMNS
+HOURLY_COLUMNS = ('collection', 'simulation', 'day', 'hour', 'metric', 'value')
+
+
+def flatten_records(records:list[tuple[str, str, dict]]) -> tuple[list[tuple], list[tuple]]:
+    """Splits daily payloads into one row per day and one long-format row per hourly metric.
+    Hourly metrics are 'travelling' and 'occupancy_<vehicle>'."""
+    daily_rows = []
+    hourly_rows = []
+    for collection, document, data in records:
+        for day, payload in data.items():
+            day = int(day)
+            daily_rows.append((collection, document, day) + tuple(payload.get(column, 0) for column in COMPARTMENT_COLUMNS))
+            for hour, travelling in payload.get('Travelling_Agents', {}).items():
+                hourly_rows.append((collection, document, day, int(hour[:2]), 'travelling', float(travelling)))
+            for hour, occupancies in payload.get('Vehicle_Occupancy', {}).items():
+                for method, occupancy in occupancies.items():
+                    hourly_rows.append((collection, document, day, int(hour[:2]), f'occupancy_{method}', float(occupancy)))
+    return (daily_rows, hourly_rows)
+
+
+class ResultSink:
+    """Destination for simulation output. Records are (collection, document, data) tuples and data is merged
+    into whatever the document already holds."""
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class FirestoreSink(ResultSink):
+    """Writes every flushed batch with a single Firestore batched write"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        batch = self.client.batch()
+        for collection, document, data in records:
+            batch.set(self.client.collection(collection).document(document), data, merge=True)
+        batch.commit()
+
+
+class MemorySink(ResultSink):
+    """In-process stand-in for Firestore, for tests and offline runs"""
+    documents:dict[tuple[str, str], dict]
+    batches:int
+
+    def __init__(self):
+        self.documents = {}
+        self.batches = 0
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        self.batches += 1
+        for collection, document, data in records:
+            self.documents.setdefault((collection, document), {}).update(data)
+
+
+class CSVSink(ResultSink):
+    """Appends rows to daily.csv and hourly.csv in the results directory"""
+
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _append(self, name:str, columns:tuple[str, ...], rows:list[tuple]):
+        if (not rows):
+            return
+        file_path = os.path.join(self.path, name)
+        new_file = not os.path.exists(file_path)
+        with open(file_path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if (new_file):
+                writer.writerow(columns)
+            writer.writerows(rows)
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        daily_rows, hourly_rows = flatten_records(records)
+        self._append('daily.csv', DAILY_COLUMNS, daily_rows)
+        self._append('hourly.csv', HOURLY_COLUMNS, hourly_rows)
+
+
+class ParquetSink(ResultSink):
+    """Buffers rows and appends them as Parquet part files under daily/ and hourly/, readable as one dataset"""
+
+    def __init__(self, path:str, rows_per_file:int=50000):
+        if (pa is None):
+            raise ImportError("ParquetSink requires pyarrow. Install it or use the csv or sqlite result sink.")
+        self.path = path
+        self.rows_per_file = rows_per_file
+        self.buffers = {'daily':[], 'hourly':[]}
+        self.parts = 0
+        for name in self.buffers:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+
+    def _flush(self, name:str, columns:tuple[str, ...]):
+        rows = self.buffers[name]
+        if (not rows):
+            return
+        table = pa.table({column:[row[i] for row in rows] for i, column in enumerate(columns)})
+        pq.write_table(table, os.path.join(self.path, name, f'part-{os.getpid()}-{time.time_ns()}-{self.parts}.parquet'))
+        self.parts += 1
+        rows.clear()
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        daily_rows, hourly_rows = flatten_records(records)
+        self.buffers['daily'].extend(daily_rows)
+        self.buffers['hourly'].extend(hourly_rows)
+        if (len(self.buffers['hourly']) >= self.rows_per_file):
+            self.close()
+
+    def close(self):
+        self._flush('daily', DAILY_COLUMNS)
+        self._flush('hourly', HOURLY_COLUMNS)
+
+
+class SQLiteSink(ResultSink):
+    """Stores results in a SQLite file keyed by (collection, simulation, day). Rewriting a day replaces it,
+    matching the merge semantics of the Firestore documents."""
+
+    def __init__(self, path:str):
+        directory = os.path.dirname(path)
+        if (directory):
+            os.makedirs(directory, exist_ok=True)
+        # used by the writer thread, closed from the simulation thread once the writer has stopped
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS daily (collection TEXT, simulation TEXT, day INTEGER, '
+            'S INTEGER, E INTEGER, I INTEGER, R INTEGER, D INTEGER, Total INTEGER, '
+            'PRIMARY KEY (collection, simulation, day))'
+            )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS hourly (collection TEXT, simulation TEXT, day INTEGER, hour INTEGER, metric TEXT, value REAL, '
+            'PRIMARY KEY (collection, simulation, day, hour, metric))'
+            )
+        self.connection.commit()
+
+    def write(self, records:list[tuple[str, str, dict]]):
+        daily_rows, hourly_rows = flatten_records(records)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', daily_rows)
+            self.connection.executemany('INSERT OR REPLACE INTO hourly VALUES (?, ?, ?, ?, ?, ?)', hourly_rows)
+
+    def close(self):
+        self.connection.close()
+
+
+class BackgroundWriter:
+    """Queues records and flushes them to a sink on a worker thread in batches, retrying failed writes
+    with exponential backoff. The queue is bounded, so put only blocks when the sink has fallen far behind."""
+    error:Exception = None
+    batches:int = 0
+    records:int = 0
+    write_ns:int = 0
+
+    def __init__(self, sink:ResultSink, max_queue:int=64, batch_size:int=20, max_retries:int=5, backoff:float=0.5):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self._run, name='ResultWriter', daemon=True)
+        self.thread.start()
+
+    def put(self, collection:str, document:str, data:dict):
+        self.queue.put((collection, document, data))
+
+    def flush(self):
+        """Waits until every queued record has been written or given up on"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.sink.close()
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if (record is _STOP):
+                self.queue.task_done()
+                return
+
+            records = [record]
+            stopping = False
+            while (len(records) < self.batch_size):
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if (record is _STOP):
+                    stopping = True
+                    break
+                records.append(record)
+
+            self._write(records)
+            for _ in range(len(records) + stopping):
+                self.queue.task_done()
+            if (stopping):
+                return
+
+    def _write(self, records:list[tuple[str, str, dict]]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                start = time.perf_counter_ns()
+                self.sink.write(records)
+                self.write_ns += time.perf_counter_ns() - start
+                self.batches += 1
+                self.records += len(records)
+                return
+            except Exception as e:
+                if (attempt == self.max_retries):
+                    LOGGER.error(f"Dropping {len(records)} records after {attempt + 1} failed writes: {e}")
+                    self.error = e
+                    return
+                delay = self.backoff * (2 ** attempt)
+                LOGGER.warning(f"Write failed ({e}), retrying in {delay} seconds...")
+                time.sleep(delay)
+
+
+def firestore_client():
+    """Firestore client for the configured project. When FIRESTORE_EMULATOR_HOST is set the client talks
+    to the local emulator with anonymous credentials instead of the service account certificate."""
+    if (os.environ.get('FIRESTORE_EMULATOR_HOST')):
+        from google.auth.credentials import AnonymousCredentials
+        from google.cloud import firestore as cloud_firestore
+        LOGGER.info(f"Using Firestore emulator at {os.environ['FIRESTORE_EMULATOR_HOST']}")
+        return cloud_firestore.Client(project=os.environ.get('GCLOUD_PROJECT', 'demo-simulation'), credentials=AnonymousCredentials())
+
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+    cert_path = f'/firebase_cred/{os.environ['CERT_FILE_NAME']}' if (os.environ.get('CLOUD', 'False') == 'True') else os.environ['CERT_FILE_NAME']
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.Certificate(cert_path))
+    return firestore.client()
+
+
+def create_writer(sink:ResultSink) -> BackgroundWriter:
+    return BackgroundWriter(
+        sink, config.get('WRITER_QUEUE_SIZE', 64), config.get('WRITER_BATCH_SIZE', 20),
+        config.get('WRITER_MAX_RETRIES', 5), config.get('WRITER_BACKOFF', 0.5)
+        )
+
+
+def create_sink(kind:str=None) -> ResultSink | None:
+    """Result sink selected by the RESULT_SINK config key: firestore, sqlite, csv, parquet, memory or none.
+    Local sinks write under RESULT_PATH."""
+    kind = kind or config.get('RESULT_SINK', 'firestore')
+    path = config.get('RESULT_PATH', 'results')
+    if (kind == 'firestore'):
+        return FirestoreSink(firestore_client())
+    elif (kind == 'sqlite'):
+        return SQLiteSink(os.path.join(path, 'results.db'))
+    elif (kind == 'csv'):
+        return CSVSink(path)
+    elif (kind == 'parquet'):
+        return ParquetSink(path, config.get('RESULT_ROWS_PER_FILE', 50000))
+    elif (kind == 'memory'):
+        return MemorySink()
+    elif (kind == 'none'):
+        return None
+    raise ValueError(f"Unknown result sink '{kind}'")
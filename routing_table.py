@@ -1,65 +1,197 @@
+from collections.abc import MutableMapping
+import configuration as config
 import multiprocessing
-import itertools
 from graphing.graph import Graph, RegionGraph
 from transport.transportation import Route
 from transport.checkpoint import generate_checkpoints, Checkpoint
-from graphing.mapping import shortest_path, load_graph
+from graphing.mapping import shortest_paths_from, load_graph, map_hash, MAP_PATH
 from agents.core import Establishment
+import numpy as np
 import logging
 import pickle
+import shutil
+import json
 import os
 
 CACHE_FILE_NAME = 'routing_table.pkl'
+CACHE_DIR_NAME = 'routing_table'
+FORMAT_VERSION = 1
+LAYERS = ('city', 'railway')
+MODES = ('walk', 'ride')
 LOGGER = logging.getLogger('RoutingTable')
 
 
 worker_city:RegionGraph = None
 worker_routes:list[Route] = None
+worker_targets:list[tuple[str, int]] = None
 
-def save_dehydrated_cache(dehydrated_cache: dict):
-    """Saves the primitive dictionary to a file."""
-    LOGGER.info(f"Saving routing cache to {CACHE_FILE_NAME}...")
-    with open(CACHE_FILE_NAME, 'wb') as f:
-        pickle.dump(dehydrated_cache, f)
-    LOGGER.info("Save complete!")
 
-def rehydrate_cache(dehydrated_cache:dict, city:RegionGraph, railway:Graph, routes:list[Route]) -> dict[tuple, list[Checkpoint]]:
-    route_lookup = {route.id:route for route in routes}
-    routing_cache = {}
+class RoutingTable(MutableMapping):
+    """Read-only view over the memory-mapped routing cache with an in-memory overlay.
+    Pairs are looked up by binary search over encoded keys and their checkpoints are only
+    built the first time they are requested. Writes and deletes never touch the file."""
+
+    def __init__(self, path:str, city:RegionGraph, railway:Graph, routes:list[Route]):
+        self.path = path
+        self.graphs = {city.layer:city, railway.layer:railway}
+        self.route_lookup = {route.id:route for route in routes}
+        self._open()
+        self.materialized:dict[tuple, list[Checkpoint]] = {}
+        self.removed:set[tuple] = set()
+
+    def _open(self):
+        self.keys = np.load(os.path.join(self.path, 'keys.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+        self.legs = np.load(os.path.join(self.path, 'legs.npy'), mmap_mode='r')
+        self.node_ids = [(LAYERS[layer], number) for layer, number in np.load(os.path.join(self.path, 'nodes.npy')).tolist()]
+        self.node_index = {node_id:index for index, node_id in enumerate(self.node_ids)}
+
+    def __getstate__(self) -> dict:
+        """Snapshots keep the overlay and the cache path, the memory maps are reopened on load"""
+        return {'path':self.path, 'graphs':self.graphs, 'route_lookup':self.route_lookup, 'materialized':self.materialized, 'removed':self.removed}
+
+    def __setstate__(self, state:dict):
+        self.__dict__.update(state)
+        self._open()
+
+    def _row(self, key:tuple) -> int | None:
+        start_index = self.node_index.get(key[0])
+        dest_index = self.node_index.get(key[1])
+        if (start_index is None or dest_index is None):
+            return None
+        code = start_index * len(self.node_ids) + dest_index
+        row = int(np.searchsorted(self.keys, code))
+        if (row < len(self.keys) and self.keys[row] == code):
+            return row
+        return None
 
-    for (start_id, dest_id), pickled_checkpoints in dehydrated_cache.items():
+    def _decode(self, code:int) -> tuple:
+        start_index, dest_index = divmod(code, len(self.node_ids))
+        return (self.node_ids[start_index], self.node_ids[dest_index])
+
+    def _materialize(self, row:int) -> list[Checkpoint]:
         checkpoints = []
-        for pickled_checkpoint in pickled_checkpoints:
-            start_node_id = pickled_checkpoint['start_node']
-            start_node = city.get_node(start_node_id) if start_node_id[0] == 'city' else railway.get_node(start_node_id)
-            end_node_id = pickled_checkpoint['end_node']
-            end_node =  city.get_node(end_node_id) if end_node_id[0] == 'city' else railway.get_node(end_node_id)
-            route = route_lookup.get(pickled_checkpoint['route'])
-            checkpoint = Checkpoint(
-                mode=pickled_checkpoint['mode'], start_node=start_node, end_node=end_node, route=route
-                )
-            checkpoints.append(checkpoint)
-        routing_cache[(start_id, dest_id)] = checkpoints
-    
-    return routing_cache
+        for mode, start_index, end_index, route_id in self.legs[self.offsets[row]:self.offsets[row + 1]].tolist():
+            start_id = self.node_ids[start_index]
+            end_id = self.node_ids[end_index]
+            checkpoints.append(Checkpoint(
+                mode=MODES[mode], start_node=self.graphs[start_id[0]].get_node(start_id),
+                end_node=self.graphs[end_id[0]].get_node(end_id), route=self.route_lookup.get(route_id) if route_id >= 0 else None
+                ))
+        return checkpoints
+
+    def __getitem__(self, key:tuple) -> list[Checkpoint]:
+        checkpoints = self.materialized.get(key)
+        if (checkpoints is not None):
+            return checkpoints
+        row = None if key in self.removed else self._row(key)
+        if (row is None):
+            raise KeyError(key)
+        checkpoints = self.materialized[key] = self._materialize(row)
+        return checkpoints
+
+    def __setitem__(self, key:tuple, checkpoints:list[Checkpoint]):
+        self.removed.discard(key)
+        self.materialized[key] = checkpoints
+
+    def __delitem__(self, key:tuple):
+        in_file = key not in self.removed and self._row(key) is not None
+        if (key not in self.materialized and not in_file):
+            raise KeyError(key)
+        self.materialized.pop(key, None)
+        if (in_file):
+            self.removed.add(key)
+
+    def __iter__(self):
+        for code in self.keys.tolist():
+            key = self._decode(code)
+            if (key not in self.removed):
+                yield key
+        for key in self.materialized:
+            if (self._row(key) is None):
+                yield key
 
-def init_worker():
-    global worker_city, worker_routes
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def keys_using_routes(self, routes:list[Route]) -> list[tuple]:
+        route_ids = np.array([route.id for route in routes], dtype=np.int64)
+        leg_rows = np.flatnonzero(np.isin(self.legs[:, 3], route_ids))
+        rows = np.unique(np.searchsorted(self.offsets, leg_rows, side='right') - 1)
+        keys = {self._decode(code) for code in self.keys[rows].tolist()}
+        keys.difference_update(self.removed)
+        removed_routes = set(routes)
+        for key, checkpoints in self.materialized.items():
+            if (any(checkpoint.route in removed_routes for checkpoint in checkpoints)):
+                keys.add(key)
+        return list(keys)
+
+
+def is_cache_valid(path:str, source_hash:str) -> bool:
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    return meta.get('version') == FORMAT_VERSION and meta.get('map_hash') == source_hash
+
+def save_routing_cache(dehydrated_cache:dict, path:str, source_hash:str, city:RegionGraph, railway:Graph):
+    """Writes the primitive dictionary as flat integer arrays that can be memory-mapped."""
+    LOGGER.info(f"Saving routing cache to {path}...")
+    node_ids = list(city.nodes.keys()) + list(railway.nodes.keys())
+    node_index = {node_id:index for index, node_id in enumerate(node_ids)}
+    codes = np.array([node_index[start_id] * len(node_ids) + node_index[dest_id] for start_id, dest_id in dehydrated_cache.keys()], dtype=np.int64)
+    pickled_legs = list(dehydrated_cache.values())
+    order = np.argsort(codes, kind='stable')
+
+    offsets = np.zeros(len(order) + 1, dtype=np.int64)
+    legs = []
+    for i, pair in enumerate(order.tolist()):
+        for pickled_checkpoint in pickled_legs[pair]:
+            route_id = pickled_checkpoint['route']
+            legs.append((
+                MODES.index(pickled_checkpoint['mode']), node_index[pickled_checkpoint['start_node']],
+                node_index[pickled_checkpoint['end_node']], route_id if route_id is not None else -1
+                ))
+        offsets[i + 1] = len(legs)
+
+    temporary_path = f'{path}.tmp'
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    os.makedirs(temporary_path)
+    np.save(os.path.join(temporary_path, 'nodes.npy'), np.array([(LAYERS.index(layer), number) for layer, number in node_ids], dtype=np.int64).reshape(-1, 2))
+    np.save(os.path.join(temporary_path, 'keys.npy'), codes[order])
+    np.save(os.path.join(temporary_path, 'offsets.npy'), offsets)
+    np.save(os.path.join(temporary_path, 'legs.npy'), np.array(legs, dtype=np.int32).reshape(-1, 4))
+    with open(os.path.join(temporary_path, 'meta.json'), 'w') as f:
+        json.dump({'version':FORMAT_VERSION, 'map_hash':source_hash, 'pairs':len(order), 'legs':len(legs)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(temporary_path, path)
+    LOGGER.info("Save complete!")
+
+def init_worker(targets:list[tuple[str, int]]):
+    global worker_city, worker_routes, worker_targets
     
     city_data, _, routes_data = load_graph()
     worker_city = city_data
     worker_routes = routes_data
+    worker_targets = targets
 
 
-def compute_single_path(pair:tuple[tuple[str, int], tuple[str, int]]):
-    start_id, dest_id = pair
-    
+def compute_paths_from(start_id:tuple[str, int]) -> list[tuple[tuple[str, int], tuple[str, int], list[dict]]]:
     start_node = worker_city.get_node(start_id)
-    dest_node = worker_city.get_node(dest_id)
+    dest_nodes = [worker_city.get_node(dest_id) for dest_id in worker_targets]
     
-    raw_path = shortest_path(start_node, dest_node, worker_routes)
+    raw_paths = shortest_paths_from(start_node, dest_nodes, worker_routes)
     
-    if raw_path:
+    results = []
+    for dest_id in worker_targets:
+        if (dest_id == start_id):
+            continue
+        raw_path = raw_paths.get(dest_id)
+        if not raw_path:
+            results.append((start_id, dest_id, []))
+            continue
+
         checkpoints = generate_checkpoints(raw_path)
         pickable_checkpoints = []
         for cp in checkpoints:
@@ -70,37 +202,41 @@ def compute_single_path(pair:tuple[tuple[str, int], tuple[str, int]]):
                 'route': cp.route.id if cp.route else None
             }
             pickable_checkpoints.append(pickable)
-        
-        return (start_id, dest_id, pickable_checkpoints)
-    return (start_id, dest_id, [])
+        results.append((start_id, dest_id, pickable_checkpoints))
+    return results
+
 
+def build_routing_cache(establishments:list[Establishment], city:RegionGraph, railway:Graph, routes:list[Route]) -> RoutingTable:
+    source_hash = map_hash(config.get('MAP_PATH', MAP_PATH))
+    if (is_cache_valid(CACHE_DIR_NAME, source_hash)):
+        LOGGER.info(f"Found routing cache {CACHE_DIR_NAME} for the current map. Memory-mapping it...")
+        return RoutingTable(CACHE_DIR_NAME, city, railway, routes)
 
-def build_routing_cache(establishments:list[Establishment], city:RegionGraph, railway:Graph, routes:list[Route]) -> dict[tuple, list[Checkpoint]]:
     if os.path.exists(CACHE_FILE_NAME):
-        LOGGER.info(f"Found existing {CACHE_FILE_NAME}! Loading from disk...")
+        LOGGER.warning(f"Converting legacy {CACHE_FILE_NAME}, assuming it was built from the current map...")
         with open(CACHE_FILE_NAME, 'rb') as f:
             pickled_cache = pickle.load(f)
-        LOGGER.info(f'Done reading file.')
-        return rehydrate_cache(pickled_cache, city, railway, routes)
+        save_routing_cache(pickled_cache, CACHE_DIR_NAME, source_hash, city, railway)
+        return RoutingTable(CACHE_DIR_NAME, city, railway, routes)
 
     LOGGER.info("Gathering origin-destination pairs...")
     est_node_ids = list(set([est.node.id for est in establishments]))
     
-    pairs_to_compute = list(itertools.permutations(est_node_ids, 2))
-    LOGGER.info(f"Total paths to compute: {len(pairs_to_compute)}")
+    LOGGER.info(f"Total paths to compute: {len(est_node_ids) * (len(est_node_ids) - 1)} from {len(est_node_ids)} origins")
 
     pickled_cache = {}
     
 
     LOGGER.info("Igniting multiprocessing pool...")
-    with multiprocessing.Pool(initializer=init_worker) as pool:
+    with multiprocessing.Pool(initializer=init_worker, initargs=(est_node_ids,)) as pool:
         
-        results = pool.imap_unordered(compute_single_path, pairs_to_compute, chunksize=100)
+        results = pool.imap_unordered(compute_paths_from, est_node_ids)
         
-        for start_id, dest_id, pickled_checkpoints in results:
-            pickled_cache[(start_id, dest_id)] = pickled_checkpoints
+        for origin_results in results:
+            for start_id, dest_id, pickled_checkpoints in origin_results:
+                pickled_cache[(start_id, dest_id)] = pickled_checkpoints
     
-    save_dehydrated_cache(pickled_cache)
+    save_routing_cache(pickled_cache, CACHE_DIR_NAME, source_hash, city, railway)
 
     LOGGER.info("Routing cache built successfully!")
-    return rehydrate_cache(pickled_cache, city, railway, routes)
\ No newline at end of file
+    return RoutingTable(CACHE_DIR_NAME, city, railway, routes)
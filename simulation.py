@@ -5,16 +5,22 @@ from objects import Disease, Status
 from multiprocessing import Process
 from graphing.mapping import load_graph
 from graphing.graph import RegionGraph
-from agents.agent import AGE_RANGE_DISTRIBUTION, Agent, WorkingAgent, next_occurrence_of_hour, handle_agent_events
-from agents.core import WEEKEND_FIRMS
+from agents.agent import AGE_RANGE_DISTRIBUTION, Agent, WorkingAgent, check_for_infections, next_occurrence_of_hour, handle_agent_events
+from agents.core import WEEKEND_FIRMS, Household, Firm
+from agents.table import AgentTable, COMPARTMENT_CODES
 from transport.transportation import Transportation, RoutedTransportation, handle_route_events, handle_transportation_events, BusRoute, JeepRoute, TrainRoute
 from interventions import handle_policy_events
 from routing_table import build_routing_cache
-from time import time_ns
+from results import ResultSink, BackgroundWriter, create_writer, create_sink
+from time import time_ns, perf_counter_ns
 from datetime import datetime
 import interventions
+import profiling
+import snapshot
 import manager
+import counters
 import random
+import numpy as np
 import pygame as pg
 import logging
 import math
@@ -23,19 +29,49 @@ import sys
 import uuid
 import json
 
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-
 LOGGER = logging.getLogger('Simulation')
+"""Set by the entry point so a run opens the configured result sink once it knows it won't fork"""
+open_sink:bool = False
+
+def init_logging():
+    logging.basicConfig(handlers=[logging.FileHandler("logfile.txt", 'w'), logging.StreamHandler(sys.stdout)], 
+                        level=logging.DEBUG if os.environ.get('DEBUG', 'False') == 'True' else logging.INFO)
+
+def scenario_path(path:str, name:str) -> str:
+    """Per-scenario variant of an output file path, e.g. profile.json -> profile-masks.json"""
+    root, extension = os.path.splitext(path)
+    return f'{root}-{name}{extension}'
+
+def wait_for_scenario(children:dict[int, str]):
+    """Reaps one scenario child, ignoring any other child process that happens to exit"""
+    while True:
+        pid, status = os.waitpid(-1, 0)
+        name = children.pop(pid, None)
+        if (name is None):
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if (code != 0):
+            LOGGER.error(f"Scenario {name} exited with code {code}")
+        else:
+            LOGGER.info(f"Scenario {name} finished.")
+        return
 
 def daily_work(agents:list[WorkingAgent], quarantine:float,  curfew:dict, time:int) -> set[int]:
     will_work = set()
-    for agent in agents:
-        isolate = (agent.isolate and random.random() < quarantine)
-        dead = agent.SEIR_compartment == 'D'
-        out_curfew = shift_conflicts_with_curfew(agent.working_hours[0], agent.working_hours[1], curfew)
-        if (dead or isolate or out_curfew):
+    if (not agents):
+        return will_work
+
+    rows = np.fromiter((agent.row for agent in agents), dtype=np.int64, count=len(agents))
+    dead = Agent.table.compartment[rows] == COMPARTMENT_CODES['D']
+    isolate = Agent.table.isolate[rows] & (np.random.random(len(agents)) < quarantine)
+    skipped = dead | isolate
+    curfew_conflicts = {}
+    for agent, skip in zip(agents, skipped.tolist()):
+        if (skip):
+            continue
+        if (agent.working_hours not in curfew_conflicts):
+            curfew_conflicts[agent.working_hours] = shift_conflicts_with_curfew(agent.working_hours[0], agent.working_hours[1], curfew)
+        if (curfew_conflicts[agent.working_hours]):
             continue
         agent.clocked_in = False
         agent.finished_work = False
@@ -44,36 +80,18 @@ def daily_work(agents:list[WorkingAgent], quarantine:float,  curfew:dict, time:i
         will_work.add(agent.id)
     return will_work
 
-def generate_status(agents:list[Agent], time:int, active_cases:list[tuple[int, int]]) -> Status:
-    seir = {compartment:0 for compartment in Simulation.compartments}
-    for agent in agents:
-        seir[agent.SEIR_compartment] += 1
-    status = Status(time, seir, active_cases)
+def generate_status(time:int, active_cases:list[tuple[int, int]]) -> Status:
+    status = Status(time, counters.compartment_counts(), active_cases)
     return status
 
-def get_agent_states(agents:list[Agent]) -> dict[str, int]:
-    states = {}
-    for agent in agents:
-        states[agent.state] = states.get(agent.state, 0) + 1
-    return states
+def get_agent_states() -> dict[str, int]:
+    return counters.state_counts()
 
-def get_travelling_mode(agents:list[Agent]) -> dict[str, int]:
-    travel_modes = {}
-    for agent in agents:
-        if (agent.state != 'travelling'):
-            continue
-        
-        if (agent.transportation):
-            travel_modes[agent.transportation.method] = travel_modes.get(agent.transportation.method, 0) + 1
-        else:
-            travel_modes['walking'] = travel_modes.get('walking', 0) + 1
-    return travel_modes
+def get_travelling_mode() -> dict[str, int]:
+    return counters.travel_mode_counts()
 
-def get_transport_count(transportations:list[RoutedTransportation]):
-    transport_types = {}
-    for transport in transportations:
-        transport_types[transport.method] = transport_types.get(transport.method, 0) + 1
-    return transport_types
+def get_transport_count() -> dict[str, int]:
+    return counters.vehicle_counts()
 
 def _split_wrapping_interval(start: float, end: float) -> list[tuple[float, float]]:
     if start <= end:
@@ -124,14 +142,21 @@ class Simulation:
     quarantine = 0
     peak_hour:bool = False
     curfew:dict[str, int] = {}
-    step_counter = 0
-
-    def __init__(self, headless=True):
-        logging.basicConfig(handlers=[logging.FileHandler("logfile.txt", 'w'), logging.StreamHandler(sys.stdout)], 
-                            level=logging.DEBUG if os.environ.get('DEBUG', 'False') == 'True' else logging.INFO)
+    status:Status = None
+    running:bool = True
+    routines:list[manager.Routine]
+    writer:BackgroundWriter = None
+    checkpoint_due:bool = False
+    scenario:str = None
+    branch_records:list[dict] = None
+
+    def __init__(self, headless=True, environment:tuple=None, routing_table:dict=None, result_sink:ResultSink=None,
+                 population:dict=None):
+        init_logging()
         LOGGER.info(f'Initializing simulation with headless = {headless}...')
         config.init()
         manager.init()
+        profiling.init()
         
         """Initialize simulation parameters"""
         self.disease = Disease()
@@ -143,14 +168,54 @@ class Simulation:
         self.transportations = []
         self.headless = headless
         self.active_cases = []
+        self.seir_history = []
         self.collection_id = config.get("COLLECTION_ID")
         self.simulation_id = str(uuid.uuid4())
 
-        """Load environment and initialize route spawning events"""
-        environment = load_graph()
+        """Load environment, or the environment and agents of a cached population built for the same map"""
+        population_path = config.get('POPULATION_CACHE')
+        if (population is None and population_path):
+            population = snapshot.load_population(population_path)
+        if (population is not None):
+            if (environment is not None and population['environment'] is not environment):
+                """Cached agents live in the cached environment, a routing table built for another one can't serve them"""
+                LOGGER.info('Cached population belongs to another environment, using the cached environment instead.')
+                routing_table = None
+            environment = population['environment']
+        elif (environment is None):
+            environment = load_graph()
         self.graph = environment[0]
         self.railway_graph = environment[1]
         self.routes = environment[2]
+
+        """Build routing cache for agents"""
+        if (routing_table is None):
+            establishment = self.graph.get_firms()
+            establishment.extend(self.graph.get_households())
+            routing_table = build_routing_cache(establishment, self.graph, self.railway_graph, self.routes)
+        self.routing_table = routing_table
+
+        """Generate agents"""
+        if (population is not None):
+            self.agents = population['agents']
+            self.working_agents = population['working_agents']
+            self.agent_table = population['agent_table']
+            LOGGER.info('Population loaded from cache.')
+        else:
+            self.agent_table = AgentTable(
+                sum(household.resident_count for household in self.graph.get_households()),
+                config.get('AGENT_TABLE_MEMMAP', False), config.get('AGENT_TABLE_MEMMAP_DIR')
+                )
+            Agent.table = self.agent_table
+            counters.reset()
+            Household.active = {}
+            Firm.active = {}
+            RoutedTransportation.active = {}
+            self.generate_agents()
+            if (population_path):
+                snapshot.save_population(self, population_path)
+
+        """Initialize route spawning events"""
         for route in self.routes:
             manager.emit(3, manager.Event(manager.TRANSPORTATION_SPAWN, route))
         
@@ -160,24 +225,136 @@ class Simulation:
             policy = self.load_policy(pickled_policy)
             manager.emit(policy.start_time, manager.Event(manager.IMPLEMENT_POLICY, policy))
 
-        """Build routing cache for agents"""
-        establishment = self.graph.get_firms()
-        establishment.extend(self.graph.get_households())
-        self.routing_table = build_routing_cache(establishment, self.graph, self.railway_graph, self.routes)
-
-        """Generate agents"""
-        self.generate_agents()
+        self.assign_initial_compartments()
         LOGGER.info(f'Simulation initialized with {len(self.agents)} agents.')
-        
+
+        """Register recurring routines with the event manager"""
+        self.daily_hourly_occupancies = {}
+        self.daily_hourly_travelling = {}
+        self.simulation_day_time = time_ns()
+        self.register_routines()
+        self.start(0, result_sink)
+
+    @classmethod
+    def resume(cls, path:str, headless=True, result_sink:ResultSink=None) -> 'Simulation':
+        """Continues a run from a snapshot written by the checkpoint routine"""
+        init_logging()
+        config.init()
+        simulation, time = snapshot.load(path)
+        RoutedTransportation.infection_routine = next((routine for routine in simulation.routines if (routine.name == 'transport-infection')), None)
+        LOGGER.info(f'Resuming simulation {simulation.simulation_id} from {path} at day {time // (60 * 24)}...')
+        profiling.init()
+        simulation.headless = headless
+        simulation.simulation_day_time = time_ns()
+        simulation.start(time, result_sink)
+        return simulation
+
+    def __getstate__(self) -> dict:
+        """The result writer and the pygame window belong to the running process and stay out of snapshots"""
+        state = self.__dict__.copy()
+        for name in ('writer', 'clock', 'window', 'font'):
+            state.pop(name, None)
+        return state
+
+    def start(self, time:int, result_sink:ResultSink=None):
         """Mainly for visualization purposes"""
-        if (not headless):
+        if (not self.headless):
             pg.init()
             self.clock = pg.time.Clock()
             self.window = pg.display.set_mode((1080, 720))
             self.font = pg.font.Font(None, 15)
         
-        self.run()
+        if (profiling.enabled):
+            profiling.day_started(time // (60 * 24))
+        scenarios = config.get('SCENARIOS') if (self.scenario is None) else None
+        if (scenarios):
+            """Every scenario logs the shared prefix as its own, so the parent keeps the daily records instead of
+            opening a sink and no writer thread or connection is alive when it forks"""
+            if (self.branch_records is None):
+                self.branch_records = []
+            time = self.run(time, config.get('SCENARIO_BRANCH_DAY', 0) * 60 * 24)
+            if (self.running):
+                self.fork_scenarios(scenarios, time)
+        else:
+            if (result_sink is None and open_sink):
+                result_sink = create_sink()
+            if (result_sink is not None):
+                self.writer = create_writer(result_sink)
+                for record in (self.branch_records or []):
+                    self.writer.put(self.collection_id, self.simulation_id, record)
+            self.branch_records = None
+            self.run(time)
+            if (self.writer):
+                self.writer.close()
+        if (profiling.enabled):
+            writer_stats = {}
+            if (self.writer):
+                writer_stats = {'batches':self.writer.batches, 'records':self.writer.records, 'write_s':round(self.writer.write_ns / 1e9, 4)}
+            profiling.write_report({'agents':len(self.agents), 'writer':writer_stats})
+        snapshot_path = config.get('SNAPSHOT_PATH', 'snapshot.pkl')
+        if (config.get('SNAPSHOT_INTERVAL_DAYS') and not config.get('SNAPSHOT_KEEP', False) and os.path.exists(snapshot_path)):
+            os.remove(snapshot_path)
     
+    def fork_scenarios(self, scenarios:list[dict], time:int):
+        """Continues every scenario from the current state in its own forked child, so the simulated prefix is
+        shared copy-on-write instead of being rerun. At most SCENARIO_PROCESSES children run at once."""
+        if (not hasattr(os, 'fork')):
+            raise RuntimeError('Scenario forking needs os.fork, which is not available on this platform')
+        LOGGER.info(f'Forking {len(scenarios)} scenarios at day {time // (60 * 24)}...')
+        limit = config.get('SCENARIO_PROCESSES', os.cpu_count())
+        children:dict[int, str] = {}
+        for scenario in scenarios:
+            if (len(children) >= limit):
+                wait_for_scenario(children)
+            if (self.writer):
+                self.writer.flush()
+            sys.stdout.flush()
+            for handler in logging.getLogger().handlers:
+                handler.flush()
+
+            pid = os.fork()
+            if (pid == 0):
+                code = 0
+                try:
+                    self.run_scenario(scenario, time)
+                except BaseException:
+                    LOGGER.exception(f"Scenario {scenario['name']} failed")
+                    code = 1
+                logging.shutdown()
+                os._exit(code)
+            children[pid] = scenario['name']
+        while children:
+            wait_for_scenario(children)
+
+    def run_scenario(self, scenario:dict, time:int):
+        """Runs in a forked child. The scenario's policies take effect from time, or from their own start time
+        if that is later, policies that end before time are skipped, and results go to the scenario's own
+        collection and document."""
+        name = scenario['name']
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(logging.Formatter(f'%(levelname)s:%(name)s:[{name}] %(message)s'))
+        LOGGER.info(f'Scenario {name} running in process {os.getpid()}.')
+        self.scenario = name
+        self.headless = True
+        self.simulation_day_time = time_ns()
+        self.collection_id = scenario.get('collection_id', f'{self.collection_id}-{name}')
+        self.simulation_id = f'{self.simulation_id}-{name}'
+        config.put('RESULT_PATH', os.path.join(config.get('RESULT_PATH', 'results'), name))
+        config.put('SNAPSHOT_PATH', scenario_path(config.get('SNAPSHOT_PATH', 'snapshot.pkl'), name))
+        config.put('PROFILE_OUTPUT', scenario_path(config.get('PROFILE_OUTPUT', 'profile.json'), name))
+        if ('seed' in scenario):
+            random.seed(scenario['seed'])
+            np.random.seed(scenario['seed'])
+            self.disease.reset_pools()
+
+        for pickled_policy in scenario.get('policies', []):
+            policy = self.load_policy(pickled_policy)
+            if (policy.end_time is not None and policy.end_time <= time):
+                LOGGER.info(f'Skipping {policy}, it ends before the scenario branches off.')
+                continue
+            manager.emit(max(policy.start_time, time), manager.Event(manager.IMPLEMENT_POLICY, policy))
+        self.start(time, create_sink())
+
     def generate_agents(self):
         """Generate agents based on households"""
         LOGGER.info('generating agents...')
@@ -223,6 +400,7 @@ class Simulation:
             occupany_ratios.append((len(firm.resident_agents) / firm.max_workers) * 100)
         LOGGER.info(f'Firm occupancy ratios: min={min(occupany_ratios)}%, max={max(occupany_ratios)}%, avg={sum(occupany_ratios)/len(occupany_ratios)}%, std={math.sqrt(sum((x - (sum(occupany_ratios)/len(occupany_ratios)))**2 for x in occupany_ratios)/len(occupany_ratios))}%')
 
+    def assign_initial_compartments(self):
         """Assign initial SEIR compartments to agents. Assignment here is done randomly"""
         LOGGER.info('assigning initial infections...')
         assigned = set()
@@ -307,217 +485,252 @@ class Simulation:
         policy = _cls(**params)
         return policy
 
-    def handle_events(self, time:int):
-        self.step_counter += 1
+    def register_routines(self):
+        """Order of registration is the order routines run in when they share a tick"""
+        self.routines = [
+            manager.Routine('hourly-snapshot', 60, self.hourly_snapshot_routine, 60 - self.time_step),
+            manager.Routine('firestore-logging', 60 * 24, self.firestore_logging_routine, (60 * 24) - self.time_step),
+            manager.Routine('infection', 30, self.infection_routine),
+            manager.Routine('daily', 60 * 24, self.daily_routine),
+            manager.Routine('transport-infection', 2 * self.time_step, self.transport_infection_routine, self.time_step, self.has_active_transport),
+        ]
+        RoutedTransportation.infection_routine = self.routines[-1]
+        checkpoint_interval = config.get('SNAPSHOT_INTERVAL_DAYS')
+        if (checkpoint_interval):
+            self.routines.append(manager.Routine('checkpoint', checkpoint_interval * 60 * 24, self.checkpoint_routine, checkpoint_interval * 60 * 24))
+        for routine in self.routines:
+            if (profiling.enabled):
+                routine.callback = profiling.TimedRoutine(routine.name, routine.callback)
+            manager.schedule_routine(routine)
+
+    def checkpoint_routine(self, time:int):
+        """Only flags the checkpoint; the run loop writes it once every event of the tick has been handled"""
+        self.checkpoint_due = True
+
+    def checkpoint(self, time:int):
+        self.checkpoint_due = False
+        if (self.writer):
+            self.writer.flush()
+        snapshot.save(self, time, config.get('SNAPSHOT_PATH', 'snapshot.pkl'))
+
+    def hourly_snapshot_routine(self, time:int):
+        hour = (time // 60) % 24
+
+        # Vehicle Occupancy Tracker
+        hour_avg = counters.average_occupancy()
+        self.daily_hourly_occupancies[f"{hour:02d}:00"] = hour_avg
+        
+        # Travelling Agent Tracker
+        current_states = get_agent_states()
+        self.daily_hourly_travelling[f"{hour:02d}:00"] = current_states.get('travelling', 0)
+
+    def log_data_to_firestore(self, day, seir_data, occupancies_data, travelling_data):
+        """Hands the day's payload to the background writer; the simulation thread never waits on the network.
+        Before a scenario fork the payloads are also kept for the scenarios to log."""
+        total_population = sum(seir_data.values())
+        record = {str(day): {
+            **seir_data,
+            "Total": total_population,
+            "Vehicle_Occupancy": occupancies_data,
+            "Travelling_Agents": travelling_data
+        }}
+        if (self.branch_records is not None):
+            self.branch_records.append(record)
+        if (self.writer is None):
+            return
+
+        if (self.writer.error):
+            LOGGER.error(f"Firestore Sync Error: {self.writer.error}")
+            self.running = False
+            return
+
+        self.writer.put(self.collection_id, self.simulation_id, record)
+
+    def firestore_logging_routine(self, time:int):
+        day = time // (60 * 24)
+        current_status = generate_status(time, self.active_cases)
+        
+        self.log_data_to_firestore(day, current_status.SEIR_compartments, self.daily_hourly_occupancies, self.daily_hourly_travelling)
+        LOGGER.debug(f"\nLogged Day {day} to Firestore with Hourly Occupancies and Travel Data.")
+        
+        # Reset for the next day
+        self.daily_hourly_occupancies = {}
+        self.daily_hourly_travelling = {}
+
+    def infection_routine(self, time:int):
+        for household in list(Household.active):
+            if (not household.susceptible_agents or household.no_infected_agents == 0):
+                continue
+
+            present = []
+            for agent in list(household.susceptible_agents):
+                if (agent.state != 'home'):
+                    household.remove_agent(agent)
+                    continue
+                present.append(agent)
+
+            check_for_infections(
+                present,
+                self.disease.sample_infection_household_CPC(),
+                household.contact_rate(), 
+                household.infected_density(),
+                0.5, time, self.disease
+                )
+
+        for firm in list(Firm.active):
+            if (not firm.susceptible_agents or firm.no_infected_agents == 0):
+                continue
 
-        """Tick-based events"""
-        if (self.step_counter == 2):
-            for transportation in self.transportations:
-                for agent in transportation.agents:
-                    if (agent.state != 'travelling'):
+            if (firm.industry[1] >= 3):
+                chance_per_contact = self.disease.sample_infection_firm_retail_CPC()
+            else:
+                chance_per_contact = self.disease.sample_infection_firm_work_CPC()
+
+            present = []
+            for agent in list(firm.susceptible_agents):
+                if (agent.state not in {'working', 'consuming'}):
+                    firm.remove_agent(agent)
+                    continue
+                present.append(agent)
+
+            check_for_infections(
+                present,
+                chance_per_contact,
+                firm.contact_rate(), 
+                firm.infected_density(),
+                0.5, time, self.disease
+                )
+
+    def has_active_transport(self) -> bool:
+        return bool(RoutedTransportation.active)
+
+    def transport_infection_routine(self, time:int):
+        for transportation in list(RoutedTransportation.active):
+            check_for_infections(
+                list(transportation.agents),
+                self.disease.sample_infection_transport_CPC(),
+                transportation.get_contact_rate(), 
+                transportation.get_infected_density(),
+                (2 * self.time_step)/10, time, self.disease, 'travelling'
+                )
+
+    def daily_routine(self, time:int):
+        day = time // (60 * 24)
+        self.status = generate_status(time, self.active_cases)
+        self.active_cases.append((day, self.status.SEIR_compartments['I']))
+        self.seir_history.append((day, self.status.SEIR_compartments))
+        if (self.status.SEIR_compartments['I'] == 0):
+            self.running = False
+        day_delta = round((time_ns() - self.simulation_day_time) / (10**9), 2)
+        
+        LOGGER.info(f"Day {day}/{self.duration} completed in {day_delta} seconds.")
+        self.simulation_day_time = time_ns()
+        if (profiling.enabled):
+            profiling.day_started(day)
+        
+        will_work:set[int] = set()
+        for firm in self.graph.get_firms():
+            if (not firm.essential and self.essential_only):
+                continue
+            
+            in_schedule = list(firm.day_workers[day % 7])
+            agents = random.sample(in_schedule, min(len(in_schedule), firm.max_workers))
+            will_work.update(daily_work(agents, self.quarantine, self.curfew, time))
+        
+        valid_start_hour, valid_end_hour = self.get_valid_hours()
+        if (self.designated_persons):
+            for house in self.graph.get_households():
+                agents = [agent for agent in house.resident_agents if (not agent.isolate and 65 >= agent.age >= 4 and agent.SEIR_compartment != 'D')]
+                if (not agents):
+                    agents = [agent for agent in house.resident_agents if (65 >= agent.age >= 4 and agent.SEIR_compartment != 'D')]
+                if (not agents):
+                    continue
+
+                designated_agent = random.choice(agents)
+                designated_group = [designated_agent]
+
+                for agent in agents:
+                    if (agent == designated_agent):
                         continue
 
-                    agent.check_for_infection(
-                        self.disease.sample_infection_transport_CPC(),
-                        self.disease.sample_incubation_period(),
-                        transportation.get_contact_rate(), 
-                        transportation.get_infected_density(),
-                        (2 * self.time_step)/10, time
-                        )
-            self.step_counter = 0
-
-        """Event based handling"""
-        for event in manager.get(time):
+                    if (random.random() > self.designated_persons):
+                        designated_group.append(agent)
+
+                chance_to_consume = 0.3 if (day % 7) < 5 else 0.6
+                for designated in designated_group:
+                    if (random.random() < chance_to_consume):
+                        if (isinstance(designated, WorkingAgent) and designated.id in will_work):
+                            designated.errand_run = True
+                            continue
+
+                        hour = random.randrange(valid_start_hour, valid_end_hour)
+                        manager.emit(next_occurrence_of_hour(time, hour), manager.Event(manager.AGENT_GO_SHOPPING, designated))
+        else:
+            chance_to_consume = 0.3 if (day % 7) < 5 else 0.6
+            table = self.agent_table
+            ages = table.view('age')
+            isolate = table.view('isolate') & (np.random.random(table.size) < self.quarantine)
+            consuming = (np.random.random(table.size) < chance_to_consume) & (ages <= 65) & (ages >= 4)
+            consuming &= (table.view('compartment') != COMPARTMENT_CODES['D']) & ~isolate
+            for row in np.flatnonzero(consuming).tolist():
+                agent = self.agents[row]
+                if (isinstance(agent, WorkingAgent) and agent.id in will_work):
+                    agent.errand_run = True
+                    continue
+
+                hour = random.randrange(valid_start_hour, valid_end_hour)
+                manager.emit(next_occurrence_of_hour(time, hour), manager.Event(manager.AGENT_GO_SHOPPING, agent))
+
+    def handle_events(self, time:int):
+        events = manager.get(time)
+        # Routines run ahead of the events scheduled on the same tick
+        events.sort(key=lambda event: event.type != manager.SIMULATION_ROUTINE)
+        if (profiling.enabled):
+            self.handle_events_profiled(events, time)
+            return
+        for event in events:
+            manager.handle_routine_events(event, time)
+            handle_agent_events(event, time, self)
+            handle_transportation_events(event, time, self)
+            handle_route_events(event, time, self)
+            handle_policy_events(self, event, time)
+    
+    def handle_events_profiled(self, events:list[manager.Event], time:int):
+        for event in events:
+            start = perf_counter_ns()
+            manager.handle_routine_events(event, time)
             handle_agent_events(event, time, self)
             handle_transportation_events(event, time, self)
             handle_route_events(event, time, self)
             handle_policy_events(self, event, time)
+            profiling.record_event(event, perf_counter_ns() - start)
     
-    def run(self):
-        time = 0
+    def run(self, time:int=0, until:int=None) -> int:
+        """Runs from time until the duration is over, or until the given tick when branching, and returns the
+        tick it stopped at"""
         delta = 0
         draw_time = 0
         simultation_time = 0
-        status = None
-        simulation_day_time = time_ns()
-        running = True
-        states = get_agent_states(self.agents)
-
-        last_logged_day = None 
-
-        def log_data_to_firestore(day, seir_data, occupancies_data, travelling_data):
-            global running
-            try:
-                doc_ref = db.collection(self.collection_id).document(self.simulation_id)
-                total_population = sum(seir_data.values())
-                doc_ref.set({str(day): {
-                    **seir_data,
-                    "Total": total_population,
-                    "Vehicle_Occupancy": occupancies_data,
-                    "Travelling_Agents": travelling_data
-                }}, merge=True)
-            except Exception as e:
-                LOGGER.error(f"Firestore Sync Error: {e}")
-                running = False
-
-        daily_hourly_occupancies = {}
-        daily_hourly_travelling = {}
-        last_sampled_hour = None
+        self.running = True
+        states = get_agent_states()
         
         LOGGER.info('Starting simulation...')
-        while ((time // (60 * 24) < self.duration) and running):
+        while ((time // (60 * 24) < self.duration) and self.running and (until is None or time < until)):
             minute = time % 60
             hour = (time // 60) % 24
             day = time // (60 * 24)
             time_record = time_ns()
             self.peak_hour = (9 >= hour >= 6) or (20 >= hour >= 17)
-            
-            # --- HOURLY SNAPSHOT ---
-            if minute == (60 - self.time_step) and last_sampled_hour != hour:
-                last_sampled_hour = hour
-                
-                # Vehicle Occupancy Tracker
-                occupancy_lists = {}
-                for transpo in self.transportations:
-                    v_type = transpo.method
-                    if v_type not in occupancy_lists:
-                        occupancy_lists[v_type] = []
-                    occupancy_lists[v_type].append(transpo.occupancy())
-                
-                hour_avg = {}
-                for v_type, occ_list in occupancy_lists.items():
-                    hour_avg[v_type] = round(sum(occ_list) / len(occ_list), 2) if len(occ_list) > 0 else 0
-                    
-                daily_hourly_occupancies[f"{hour:02d}:00"] = hour_avg
-                
-                # Travelling Agent Tracker
-                current_states = get_agent_states(self.agents)
-                daily_hourly_travelling[f"{hour:02d}:00"] = current_states.get('travelling', 0)
-            
-            # --- FIRESTORE LOGGING ---
-            if hour == 23 and minute == (60 - self.time_step) and last_logged_day != str(day):
-                last_logged_day = str(day)
-                actual_log_time = (day * 24 * 60) + (hour * 60) + minute 
-                current_status = generate_status(self.agents, actual_log_time, self.active_cases)
-                
-                log_data_to_firestore(day, current_status.SEIR_compartments, daily_hourly_occupancies, daily_hourly_travelling)
-                LOGGER.debug(f"\nLogged Day {day} to Firestore with Hourly Occupancies and Travel Data.")
-                
-                # Reset for the next day
-                daily_hourly_occupancies = {}
-                daily_hourly_travelling = {}
-
-            """Routine every 30 minutes"""
-            if (minute == 0 or minute == 30):
-                for household in self.graph.get_households():
-                    if (not household.susceptible_agents or household.no_infected_agents == 0):
-                        continue
-
-                    for agent in list(household.susceptible_agents):
-                        if (agent.state != 'home'):
-                            household.remove_agent(agent)
-                            continue
-
-                        agent.check_for_infection(
-                            self.disease.sample_infection_household_CPC(),
-                            self.disease.sample_incubation_period(),
-                            household.contact_rate(), 
-                            household.infected_density(),
-                            0.5, time
-                            )
-
-                for firm in self.graph.get_firms():
-                    if (not firm.susceptible_agents or firm.no_infected_agents == 0):
-                        continue
-
-                    if (firm.industry[1] >= 3):
-                        chance_per_contact = self.disease.sample_infection_firm_retail_CPC()
-                    else:
-                        chance_per_contact = self.disease.sample_infection_firm_work_CPC()
-
-                    for agent in list(firm.susceptible_agents):
-                        if (agent.state not in {'working', 'consuming'}):
-                            firm.remove_agent(agent)
-                            continue
-
-                        agent.check_for_infection(
-                            chance_per_contact,
-                            self.disease.sample_incubation_period(),
-                            firm.contact_rate(), 
-                            firm.infected_density(),
-                            0.5, time
-                            )
-
-            # --- DAILY ROUTINE ---
-            if (hour == 0 and minute == 0):
-                status = generate_status(self.agents, time, self.active_cases)
-                self.active_cases.append((day, status.SEIR_compartments['I']))
-                day_delta = round((time_ns() - simulation_day_time) / (10**9), 2)
-                
-                LOGGER.info(f"Day {day}/{self.duration} completed in {day_delta} seconds.")
-                simulation_day_time = time_ns()
-                
-                will_work:set[int] = set()
-                for firm in self.graph.get_firms():
-                    if (not firm.essential and self.essential_only):
-                        continue
-                    
-                    in_schedule = list(firm.day_workers[day % 7])
-                    agents = random.sample(in_schedule, min(len(in_schedule), firm.max_workers))
-                    will_work.update(daily_work(agents, self.quarantine, self.curfew, time))
-                
-                valid_start_hour, valid_end_hour = self.get_valid_hours()
-                if (self.designated_persons):
-                    for house in self.graph.get_households():
-                        agents = [agent for agent in house.resident_agents if (not agent.isolate and 65 >= agent.age >= 4 and agent.SEIR_compartment != 'D')]
-                        if (not agents):
-                            agents = [agent for agent in house.resident_agents if (65 >= agent.age >= 4 and agent.SEIR_compartment != 'D')]
-                        if (not agents):
-                            continue
-
-                        designated_agent = random.choice(agents)
-                        designated_group = [designated_agent]
-
-                        for agent in agents:
-                            if (agent == designated_agent):
-                                continue
-
-                            if (random.random() > self.designated_persons):
-                                designated_group.append(agent)
-
-                        chance_to_consume = 0.3 if (day % 7) < 5 else 0.6
-                        for designated in designated_group:
-                            if (random.random() < chance_to_consume):
-                                if (isinstance(designated, WorkingAgent) and designated.id in will_work):
-                                    designated.errand_run = True
-                                    continue
-
-                                hour = random.randrange(valid_start_hour, valid_end_hour)
-                                manager.emit(next_occurrence_of_hour(time, hour), manager.Event(manager.AGENT_GO_SHOPPING, designated))
-                else:
-                    chance_to_consume = 0.3 if (day % 7) < 5 else 0.6
-                    for agent in self.agents:
-                        isolate = (agent.isolate and random.random() < self.quarantine)
-                        if (random.random() < chance_to_consume and 65 >= agent.age >= 4 and agent.SEIR_compartment != 'D' and not isolate):
-                            if (isinstance(agent, WorkingAgent) and agent.id in will_work):
-                                agent.errand_run = True
-                                continue
-
-                            hour = random.randrange(valid_start_hour, valid_end_hour)
-                            manager.emit(next_occurrence_of_hour(time, hour), manager.Event(manager.AGENT_GO_SHOPPING, agent))
-            
-            if (status.SEIR_compartments['I'] == 0):
-                running = False
 
             if (not self.headless):
                 """Pygame event handling"""
                 for event in pg.event.get():
                     if (event.type == pg.QUIT):
-                        running = False
-                        return
+                        self.running = False
+                        return time
                     elif (event.type == pg.KEYDOWN):
-                        if (event.key == pg.K_p and status):
-                            Process(None, status.display_report).start()
+                        if (event.key == pg.K_p and self.status):
+                            Process(None, self.status.display_report).start()
                         elif (event.key == pg.K_UP and self.simulation_multiplier < 30):
                             self.simulation_multiplier += 1
                         elif (event.key == pg.K_DOWN and self.simulation_multiplier > 1):
@@ -529,17 +742,18 @@ class Simulation:
                 """Handle events and update agent states"""
                 if (time_ns() - simultation_time >= self.simulation_ns_per_time_unit):
                     self.handle_events(time)
-                    states = get_agent_states(self.agents)
+                    states = get_agent_states()
 
-                    travel_modes = get_travelling_mode(self.agents)
+                    travel_modes = get_travelling_mode()
                     simultation_time = time_ns()
                     delta = (time_ns() - time_record) / (10**6)
                     time += self.time_step
+                    if (self.checkpoint_due):
+                        self.checkpoint(time)
                 
                 """Visualization and metrics. Here the drawing is done."""
                 if (time_ns() - draw_time >= (10**9)//60):
                     draw_time = time_ns()
-                    self.window.fill((255, 255, 255))
                     self.graph.draw(self.window, self.font,  self.layer)
                     
                     routes = sorted(self.routes, key=lambda route:route.get_average_occupancy(), reverse=True)
@@ -554,14 +768,9 @@ class Simulation:
                     states_text = self.font.render(f"States: {state_text}", False, (0, 0, 0))
                     
                     travel_text = self.font.render(f"Travel modes: {travel_modes}", False, (0, 0, 0))
-                    occupancies:dict[str, list] = {}
-                    for transpo in self.transportations:
-                        if (transpo.method in occupancies):
-                            occupancies[transpo.method].append(transpo.occupancy())
-                        else:
-                            occupancies[transpo.method] = [transpo.occupancy()]
-                    metric_text = self.font.render(f"Transportation Used: {len(self.transportations)}, avg. occupancy: {[(method, round(max(occupancy), 2))for method, occupancy in occupancies.items()]}", False, (0, 0, 0))
-                    available_transports = self.font.render(f"Live Transportation: {get_transport_count(self.transportations)}", False, (0, 0, 0))
+                    transport_count = get_transport_count()
+                    metric_text = self.font.render(f"Transportation Used: {sum(transport_count.values())}, avg. occupancy: {list(counters.average_occupancy().items())}", False, (0, 0, 0))
+                    available_transports = self.font.render(f"Live Transportation: {transport_count}", False, (0, 0, 0))
                     
                     self.window.blit(states_text, states_text.get_rect(topleft=(20, 40)))
                     self.window.blit(travel_text, travel_text.get_rect(topleft=(20, 60)))
@@ -573,18 +782,23 @@ class Simulation:
                     pg.display.update()
 
             else:
+                """Jump straight to the next tick that has a pending event or routine"""
                 self.handle_events(time)
-                time += self.time_step
+                next_time = manager.next_time()
+                time = next_time if (next_time is not None and next_time > time) else time + self.time_step
+                if (self.checkpoint_due):
+                    self.checkpoint(time)
+        return time
     
 
 if __name__ == '__main__':
-    cert_path = f'/firebase_cred/{os.environ['CERT_FILE_NAME']}' if (os.environ.get('CLOUD', 'False') == 'True') else os.environ['CERT_FILE_NAME']
-    cred = credentials.Certificate(cert_path)
-    firebase_admin.initialize_app(cred)
-    db = firestore.client()
+    config.init()
+    open_sink = True
     
     LOGGER.info(f"Simulation Start: {datetime.now().isoformat()}")
-    Simulation(os.environ.get('HEADLESS', 'True') == 'True')
+    snapshot_path = config.get('SNAPSHOT_PATH', 'snapshot.pkl')
+    if (config.get('SNAPSHOT_INTERVAL_DAYS') and os.path.exists(snapshot_path)):
+        Simulation.resume(snapshot_path, os.environ.get('HEADLESS', 'True') == 'True')
+    else:
+        Simulation(os.environ.get('HEADLESS', 'True') == 'True')
     LOGGER.info(f"Simulation End: {datetime.now().isoformat()}")
-
-        
\ No newline at end of file
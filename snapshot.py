@@ -0,0 +1,171 @@
+import configuration as config
+from agents.agent import Agent
+from agents.core import Establishment, Household, Firm
+from graphing.core import Node, Edge, Region
+from graphing.mapping import map_hash, MAP_PATH
+from transport.transportation import Route, Transportation, RoutedTransportation
+import numpy as np
+import manager
+import counters
+import copyreg
+import hashlib
+import logging
+import pickle
+import random
+import json
+import os
+
+LOGGER = logging.getLogger('Snapshot')
+
+"""A snapshot pickles everything reachable from the simulation together with the module and class level state
+around it: the manager calendar, id counters, active-site indexes, population counters, the configuration and both
+random generators. Restoring it continues the run exactly where it stopped."""
+FORMAT_VERSION = 1
+ID_COUNTERS = ((Establishment, 'id'), (Agent, 'counter'), (Region, 'id'), (Route, 'id'), (Transportation, 'id'), (manager.Routine, 'counter'))
+ACTIVE_INDEXES = (Household, Firm, RoutedTransportation)
+COUNTERS = ('compartments', 'states', 'travel_modes', 'vehicles', 'vehicle_loads')
+# Model objects link to each other (nodes, edges, establishments, agents, vehicles, events) deep enough to exhaust
+# the recursion limit of a plain pickle, so their state is written in flat batches after everything else.
+DEFERRED_TYPES = (Node, Edge, Region, Establishment, Agent, Route, Transportation, manager.Event)
+POPULATION_CONFIG_KEYS = ('MAP_PATH', 'CONTACT_RATES', 'BASE_CAPACITY_RATIO', 'AGENT_TABLE_MEMMAP')
+
+
+def _class_state() -> dict:
+    return {
+        'id_counters':[getattr(cls, name) for cls, name in ID_COUNTERS],
+        'active':[cls.active for cls in ACTIVE_INDEXES],
+        'counters':[getattr(counters, name) for name in COUNTERS],
+        }
+
+
+def _restore_class_state(state:dict):
+    for (cls, name), value in zip(ID_COUNTERS, state['id_counters']):
+        setattr(cls, name, value)
+    for cls, active in zip(ACTIVE_INDEXES, state['active']):
+        cls.active = active
+    for name, values in zip(COUNTERS, state['counters']):
+        target = getattr(counters, name)
+        target.clear()
+        target.update(values)
+
+
+class _Pickler(pickle.Pickler):
+    """Writes model objects as empty shells and queues their state, so no object is nested inside another"""
+
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.deferred = []
+
+    def reducer_override(self, obj):
+        if (isinstance(obj, DEFERRED_TYPES)):
+            self.deferred.append(obj)
+            return (copyreg.__newobj__, (type(obj),))
+        return NotImplemented
+
+
+def _build(obj, state):
+    """Same as pickle's BUILD step for objects without __setstate__"""
+    if (isinstance(state, tuple)):
+        state, slots = state
+        for name, value in slots.items():
+            setattr(obj, name, value)
+    if (state):
+        obj.__dict__.update(state)
+
+
+def _dump(state:dict, path:str):
+    """The memo is shared between the dumps, so each batch only refers back to the shells already written.
+    The file is replaced atomically so a preempted write never corrupts the last snapshot, and each process writes
+    its own temporary file so replicates caching the same population don't clash."""
+    directory = os.path.dirname(path)
+    if (directory):
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as f:
+        pickler = _Pickler(f)
+        pickler.dump(state)
+        while pickler.deferred:
+            batch = pickler.deferred
+            pickler.deferred = []
+            pickler.dump([(obj, obj.__getstate__()) for obj in batch])
+        pickler.dump(None)
+    os.replace(temporary_path, path)
+
+
+def _load(path:str) -> dict:
+    with open(path, 'rb') as f:
+        unpickler = pickle.Unpickler(f)
+        state = unpickler.load()
+        batch = unpickler.load()
+        while batch is not None:
+            for obj, obj_state in batch:
+                _build(obj, obj_state)
+            batch = unpickler.load()
+    if (state.get('version') != FORMAT_VERSION):
+        raise ValueError(f"Snapshot {path} has format version {state.get('version')}, expected {FORMAT_VERSION}")
+    return state
+
+
+def save(simulation, time:int, path:str):
+    """Snapshot of the simulation at a tick boundary. time is the next tick the run would handle."""
+    state = {
+        'version':FORMAT_VERSION,
+        'time':time,
+        'simulation':simulation,
+        'config':config.__config,
+        'manager':(manager._events, manager._ticks, manager._slots, manager._time_step),
+        'random':random.getstate(),
+        'numpy_random':np.random.get_state(),
+        **_class_state(),
+        }
+    _dump(state, path)
+    LOGGER.info(f"Snapshot of day {time // (60 * 24)} written to {path}")
+
+
+def load(path:str) -> tuple[object, int]:
+    """Restores a snapshot written by save and returns the simulation with the tick to resume from"""
+    state = _load(path)
+    config.__config = state['config']
+    manager._events, manager._ticks, manager._slots, manager._time_step = state['manager']
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy_random'])
+    _restore_class_state(state)
+    simulation = state['simulation']
+    Agent.table = simulation.agent_table
+    return (simulation, state['time'])
+
+
+def population_key() -> str:
+    """Identifies the map and the settings that population synthesis depends on"""
+    digest = hashlib.sha256(map_hash(config.get('MAP_PATH', MAP_PATH)).encode())
+    digest.update(json.dumps({key:config.get(key) for key in POPULATION_CONFIG_KEYS}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def save_population(simulation, path:str):
+    """Caches the environment and the generated agents, before any infection is seeded or event is scheduled"""
+    state = {
+        'version':FORMAT_VERSION,
+        'key':population_key(),
+        'environment':(simulation.graph, simulation.railway_graph, simulation.routes),
+        'agents':simulation.agents,
+        'working_agents':simulation.working_agents,
+        'agent_table':simulation.agent_table,
+        **_class_state(),
+        }
+    _dump(state, path)
+    LOGGER.info(f"Population of {len(simulation.agents)} agents cached to {path}")
+
+
+def load_population(path:str) -> dict | None:
+    """Restores a cached population, or returns None when there is none for the current map and settings.
+    The random generators are left alone so replicates still diverge after the population."""
+    if (not os.path.exists(path)):
+        return None
+    state = _load(path)
+    if (state['key'] != population_key()):
+        LOGGER.info(f"Population cache {path} was built for another map or configuration, regenerating...")
+        return None
+    _restore_class_state(state)
+    Agent.table = state['agent_table']
+    return state
@@ -8,6 +8,7 @@ import math
 import random
 import logging
 import manager
+import counters
 import traceback
 
 LOGGER = logging.getLogger('Transportation')
@@ -17,9 +18,15 @@ class Route:
     id:int = 0
     spawn_time:int
     ordered_nodes:list[Node]
-    transportations:list['RoutedTransportation']
+    stop_positions:dict[Node, list[int]]
+    edge_positions:dict[Edge, int]
     expected_speed:int = 150
     capacity_ratio:int = 1
+    # Occupancy summed over every vehicle the route has spawned, kept up to date by the vehicles themselves
+    vehicle_count:int = 0
+    occupancy_total:float = 0
+    drawn_view:tuple = None
+    drawn_points:list[tuple[int, int]] = None
     
 
     def __init__(self, spawn_node:Node, path:list[Edge], graph:Graph, spawn_time:int, peak_spawn:int):
@@ -29,9 +36,9 @@ class Route:
         self.spawn_time = spawn_time
         self.spawn_node = spawn_node
         self.peak_spawn = peak_spawn
-        self.transportations = []
         Route.id += 1
         self.ordered_nodes = self.generate_ordered_nodes()
+        self.index_stops()
 
     def generate_ordered_nodes(self) -> list[Node]:
         nodes = [self.spawn_node]
@@ -40,6 +47,25 @@ class Route:
             current = edge.get_adjacent_node(current)
             nodes.append(current)
         return nodes
+
+    def index_stops(self):
+        """Precomputes stop and edge positions so searches and vehicles never scan the route lists"""
+        self.stop_positions = {}
+        for position, node in enumerate(self.ordered_nodes):
+            self.stop_positions.setdefault(node, []).append(position)
+        self.edge_positions = {}
+        for position, edge in enumerate(self.path):
+            self.edge_positions.setdefault(edge, position)
+        for node in self.stop_positions:
+            node.routes.append(self)
+
+    def reaches(self, node:Node, target:Node) -> bool:
+        """Whether target is a stop at or after the first visit of node along this route"""
+        positions = self.stop_positions.get(node)
+        target_positions = self.stop_positions.get(target)
+        if (not positions or not target_positions):
+            return False
+        return target_positions[-1] >= positions[0]
     
     def __str__(self):
         return f"Route {self.id} from {self.spawn_node.id} to {self.path[-1].get_adjacent_node(self.path[-1].nodes[1]).id if self.path else self.spawn_node.id}"
@@ -49,24 +75,24 @@ class Route:
         pass
 
     def get_average_occupancy(self) -> float:
-        occupancies = [transportation.occupancy() for transportation in self.transportations]
-        return round(sum(occupancies)/len(occupancies), 2) if occupancies else 0
+        return round(self.occupancy_total / self.vehicle_count, 2) if self.vehicle_count else 0
 
     def next_edge(self, current_edge:Edge) -> Edge | None:
         if (len(self.path) == 0):
             return None
         if (current_edge is None):
             return self.path[0]
-        index = self.path.index(current_edge)
+        index = self.edge_positions[current_edge]
         return self.path[index + 1] if index + 1 < len(self.path) else None
 
     def draw(self, window:pg.Rect, graph:Graph):
-        x_offset = graph.x_offset if graph.x_temp_offset == None else graph.x_temp_offset
-        y_offset = graph.y_offset if graph.y_temp_offset == None else graph.y_temp_offset
+        x_offset, y_offset = graph.get_offset()
         average_occupancy = self.get_average_occupancy()
 
-        points = [(node.pos[0] + x_offset, node.pos[1] + y_offset) for node in self.ordered_nodes]
-        pg.draw.lines(window, (255, int(255*(1 - average_occupancy)), 0), False, points, 2)
+        if (self.drawn_view != (x_offset, y_offset)):
+            self.drawn_points = [(node.pos[0] + x_offset, node.pos[1] + y_offset) for node in self.ordered_nodes]
+            self.drawn_view = (x_offset, y_offset)
+        pg.draw.lines(window, (255, int(255*(1 - min(average_occupancy, 1))), 0), False, self.drawn_points, 2)
 
 
 class JeepRoute(Route):
@@ -80,7 +106,6 @@ class JeepRoute(Route):
             transportation = RoutedTransportation('jeep', self.expected_speed, passenger[1], self.capacity_ratio, passenger[0], 0, self.spawn_node, self)
             transportation.expected_contact_rate = config.get('CONTACT_RATES', {}).get('JEEP', 3.5)
             _transportations.append(transportation)
-            self.transportations.append(transportation)
         return _transportations
 
 
@@ -91,7 +116,6 @@ class BusRoute(Route):
     def generate_transportation(self, current_time) -> list['RoutedTransportation']:
         transportation = RoutedTransportation('bus', self.expected_speed, 50, self.capacity_ratio, 40, 0, self.spawn_node, self)
         transportation.expected_contact_rate = config.get('CONTACT_RATES', {}).get('BUS', 4.5)
-        self.transportations.append(transportation)
         return [transportation]
 
 
@@ -113,14 +137,14 @@ class TrainRoute(Route):
 
         transportation = RoutedTransportation('rail', self.expected_speed, absolute_max, self.capacity_ratio, 900, seats_taken, self.spawn_node, self)
         transportation.expected_contact_rate = config.get('CONTACT_RATES', {}).get('TRAIN', 8.5)
-        self.transportations.append(transportation)
         return [transportation]
 
 
 class Transportation:
     id:int = 0
-    agents:list
+    agents:dict
     no_infected_agents:float = 0
+    no_susceptible_agents:int = 0
     current_edge:Edge = None
 
     def __init__(self, method:str, speed:float, current_node:Node, path:list[Edge]=[]):
@@ -129,9 +153,34 @@ class Transportation:
         self.speed = speed
         self.path = path
         self.id = Transportation.id
-        self.agents = []
+        self.agents = {}
         self.path = path
         Transportation.id += 1
+
+    def add_agent(self, agent):
+        self.agents[agent] = None
+        self.count_agent(agent, agent.SEIR_compartment, 1)
+
+    def remove_agent(self, agent):
+        del self.agents[agent]
+        self.count_agent(agent, agent.SEIR_compartment, -1)
+
+    def sync_agent_state(self, agent, old_compartment:str):
+        """Called by the agent whenever their SEIR state changes while on board."""
+        self.count_agent(agent, old_compartment, -1)
+        self.count_agent(agent, agent.SEIR_compartment, 1)
+
+    def count_agent(self, agent, compartment:str, sign:int):
+        if (compartment == 'I'):
+            self.no_infected_agents += sign * agent.infection_multiplier
+            if (self.no_infected_agents < 1e-9):
+                self.no_infected_agents = 0.0
+        elif (compartment == 'S'):
+            self.no_susceptible_agents += sign
+        self.update_activity()
+
+    def update_activity(self):
+        pass
     
     def transport(self, current_time:int):
         self.current_edge = self.path.pop(0)
@@ -141,6 +190,10 @@ class Transportation:
 
 class RoutedTransportation(Transportation):
     expected_contact_rate:float = 5.0
+    manifest:dict[Node, dict]
+    active:dict['RoutedTransportation', None] = {}
+    # Transport infection routine, idle while no vehicle is in the active index
+    infection_routine:manager.Routine = None
 
     def __init__(self, method:str, speed:float, max_passenger:int, capacity_ratio:float, suggested_passenger:int, external_passenger:int, current_node:Node, route:Route):
         super().__init__(method=method, speed=speed, current_node=current_node)
@@ -149,6 +202,56 @@ class RoutedTransportation(Transportation):
         self.suggested_passenger = suggested_passenger
         self.external_passenger = external_passenger
         self.capacity_ratio = capacity_ratio
+        self.manifest = {}
+        route.vehicle_count += 1
+        route.occupancy_total += external_passenger / max_passenger
+
+    def add_agent(self, agent):
+        """Passengers are bucketed by the stop they alight at, which is also kept as their value in agents"""
+        stop = agent.checkpoints[0].end_node
+        super().add_agent(agent)
+        self.agents[agent] = stop
+        self.manifest.setdefault(stop, {})[agent] = None
+        self.change_load(1)
+
+    def remove_agent(self, agent):
+        bucket = self.manifest.get(self.agents[agent])
+        super().remove_agent(agent)
+        if (bucket):
+            bucket.pop(agent, None)
+        self.change_load(-1)
+
+    def change_load(self, delta:int):
+        """Keeps the population-wide and route occupancy aggregates in step with the passenger count"""
+        counters.change_load(self.method, self.max_passenger, delta)
+        self.route.occupancy_total += delta / self.max_passenger
+
+    def update_activity(self):
+        """Keeps the vehicle in the active index while it carries both susceptible and infected passengers"""
+        if (self.no_susceptible_agents and self.no_infected_agents != 0):
+            if (not self.active and self.infection_routine is not None):
+                manager.wake_routine(self.infection_routine)
+            self.active[self] = None
+        else:
+            self.active.pop(self, None)
+
+    def board_waiting_agents(self, time:int, compliance_rate:float):
+        """Boards agents queued at the current node for any stop this route still reaches"""
+        node = self.current_node
+        for target in list(node.waiting):
+            if (not self.route.reaches(node, target)):
+                continue
+            queue = node.waiting[target]
+            while (queue and not self.is_full()):
+                agent = next(iter(queue))
+                del queue[agent]
+                if (agent.state != 'waiting' or agent.current_node is not node or agent.transportation or agent.checkpoints[0].end_node is not target):
+                    continue
+                agent.ride_transportation(self, time, compliance_rate)
+            if (not queue):
+                del node.waiting[target]
+            if (self.is_full()):
+                return
 
     def is_full(self) -> bool:
         return (len(self.agents) + self.external_passenger) >= int(self.max_passenger * self.capacity_ratio)
@@ -182,18 +285,8 @@ def handle_route_events(event:manager.Event, time:int, simulation):
         for route in routes:
             transports = route.generate_transportation(current_time=time)
             for transport in transports:
-                for agent in list(transport.current_node.agents):
-                    if (agent.state != 'waiting'):
-                        transport.current_node.agents.remove(agent)
-                        continue
-
-                    current_leg = agent.checkpoints[0]
-                    if (current_leg.mode == 'ride' and current_leg.end_node in transport.route.ordered_nodes):
-                        current_index = transport.route.ordered_nodes.index(transport.current_node)
-                        for node in transport.route.ordered_nodes[current_index:]:
-                            if (not transport.is_full() and current_leg.end_node == node):
-                                agent.ride_transportation(transport, time, simulation.transpo_capacity_compliance)
-                                break
+                counters.add_vehicle(transport.method, transport.max_passenger, transport.external_passenger)
+                transport.board_waiting_agents(time, simulation.transpo_capacity_compliance)
                 transport.transport(time)
             simulation.transportations.extend(transports)
             spawn_interval = route.spawn_time if not simulation.peak_hour else route.peak_spawn
@@ -206,33 +299,20 @@ def handle_transportation_events(event:manager.Event, time:int, simulation):
         LOGGER.debug(f"Handling transportation arrival for {len(event.get_objects())} transportations at time {time}.")
         for transport in _transportations:
             transport.current_node = transport.current_edge.get_adjacent_node(transport.current_node)
-            transpo_agents = list(transport.agents)
-            for agent in transpo_agents:
+            for agent in list(transport.manifest.pop(transport.current_node, ())):
                 if (agent.state != 'travelling'):
-                    transport.agents.remove(agent)
+                    transport.remove_agent(agent)
                     agent.transportation = None
                     continue
 
-                if (transport.current_node.id == agent.checkpoints[0].end_node.id):
-                    agent.alight_transportation()
-                    agent.arrival(time, simulation.company_capacity_compliance)
+                agent.alight_transportation()
+                agent.arrival(time, simulation.company_capacity_compliance)
             
             getting_off_external = int(transport.external_passenger * random.uniform(0.2, 0.5))
             transport.external_passenger -= getting_off_external
+            transport.change_load(-getting_off_external)
 
-            node_agents = list(transport.current_node.agents)
-            for agent in node_agents:
-                if (agent.state != 'waiting'):
-                    transport.current_node.agents.remove(agent)
-                    continue
-
-                current_leg = agent.checkpoints[0]
-                if (current_leg.mode == 'ride' and current_leg.end_node in transport.route.ordered_nodes):
-                    current_index = transport.route.ordered_nodes.index(transport.current_node)
-                    for node in transport.route.ordered_nodes[current_index:]:
-                        if (not transport.is_full() and current_leg.end_node == node and not agent.transportation):
-                            agent.ride_transportation(transport, time, simulation.transpo_capacity_compliance)
-                            break
+            transport.board_waiting_agents(time, simulation.transpo_capacity_compliance)
                 
             transport.transport(time)
     elif (event.type == manager.PRIVATE_TRANSPORTATION_ARRIVED):
@@ -242,7 +322,7 @@ def handle_transportation_events(event:manager.Event, time:int, simulation):
                 continue
 
             transport.current_node = transport.current_edge.get_adjacent_node(transport.current_node)
-            agent = transport.agents[0]
+            agent = next(iter(transport.agents))
             if (transport.current_node.id == agent.destination.node.id):
                 agent.alight_transportation()
                 agent.arrival(time, simulation.company_capacity_compliance, transport.current_node)
@@ -256,3 +336,8 @@ def handle_transportation_events(event:manager.Event, time:int, simulation):
         LOGGER.debug(f"Handling transportation despawn for {len(event.get_objects())} transportations at time {time}.")
         for transport in _transportations:
             simulation.transportations.remove(transport)
+            for agent in list(transport.agents):
+                transport.remove_agent(agent)
+                agent.transportation = None
+            RoutedTransportation.active.pop(transport, None)
+            counters.remove_vehicle(transport.method, transport.max_passenger, transport.external_passenger)